@@ -0,0 +1,83 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import metrics
+
+
+class Overloaded(Exception):
+    '''
+    Raised when a request is turned away, `retry_after` is the hint (in seconds) for the client.
+    '''
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController():
+    '''
+    Bounds the requests that hold a decoded image and model activations at the same time.
+
+    At most `max_concurrency` requests run, at most `max_queue` more wait for a slot, and a
+    waiting request gives up once it has waited `queue_timeout` seconds. Everything else is
+    rejected right away, before the upload is even read.
+    '''
+    def __init__(self, max_concurrency: int = 4, max_queue: int = 16, queue_timeout: float = 10, retry_after: int = 1):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._running = 0
+        self._rejected = 0
+
+    def acquire(self) -> float:
+        # takes a slot or raises Overloaded, gives the seconds waited for it. release() gives it back
+        start = time.perf_counter()
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._rejected += 1
+                metrics.QUEUE_WAIT_SECONDS.observe('rejected', 0.)
+                raise Overloaded('too many queued requests', self.retry_after)
+            self._waiting += 1
+
+        acquired = self._slots.acquire(timeout=self.queue_timeout)
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._rejected += 1
+            else:
+                self._running += 1
+        if not acquired:
+            metrics.QUEUE_WAIT_SECONDS.observe('timeout', waited)
+            raise Overloaded('timed out waiting for a free slot', self.retry_after)
+        metrics.QUEUE_WAIT_SECONDS.observe('admitted', waited)
+        return waited
+
+    def release(self):
+        with self._lock:
+            self._running -= 1
+        self._slots.release()
+
+    @contextmanager
+    def admit(self):
+        waited = self.acquire()
+        metrics.record_timings([('queue', waited)], observe=False)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'running': self._running,
+                'waiting': self._waiting,
+                'rejected': self._rejected,
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+            }
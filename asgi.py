@@ -0,0 +1,261 @@
+'''
+ASGI entry point, serves the same /changeBg api as server.py.
+
+Uploads are read and responses written on the event loop. Requests are admitted by the same
+AdmissionController as in the flask app, the wait for a slot happens on a helper thread. Decoding,
+detection, inference and encoding run on an executor with one thread per slot, which is the only
+place that touches the models and the face detector.
+
+  uvicorn asgi:app --host 0.0.0.0 --port 8001
+'''
+import asyncio, base64, json, tarfile, time, zipfile
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from admission import Overloaded
+import metrics
+from bp import anime_style_transfer as service
+from util import decode_received_image_data
+
+# one thread per admission slot, and one for every request that may wait for a slot
+admission = service.admission
+executor = ThreadPoolExecutor(max_workers=admission.max_concurrency, thread_name_prefix='inference')
+waiters = ThreadPoolExecutor(max_workers=admission.max_concurrency + admission.max_queue, thread_name_prefix='admission')
+
+def error(message, status_code, headers=None):
+  return Response(json.dumps({'error': message}), status_code, headers, media_type='application/json')
+
+def overloaded(message):
+  return error(message, 503, {'Retry-After': str(admission.retry_after)})
+
+async def acquire():
+  # a slot of the admission controller, taken on a helper thread. gives the seconds waited
+  future = asyncio.get_running_loop().run_in_executor(waiters, admission.acquire)
+  try:
+    return await asyncio.shield(future)
+  except asyncio.CancelledError:
+    # the client is gone, a slot the thread still gets is given back right away
+    future.add_done_callback(lambda f: f.exception() is None and admission.release())
+    raise
+
+@asynccontextmanager
+async def admitted():
+  waited = await acquire()
+  try:
+    yield waited
+  finally:
+    admission.release()
+
+class AdmittedStreamingResponse(StreamingResponse):
+  # gives the admission slot back once the response is sent, or sending failed or was cancelled.
+  # a finally in the body iterator would not run for a client that left before the first chunk
+  async def __call__(self, scope, receive, send):
+    try:
+      await super().__call__(scope, receive, send)
+    finally:
+      admission.release()
+
+def best_match(accept):
+  # same preference as flask's best_match: highest q wins, the order of response_formats breaks ties
+  offered = list(service.response_formats)
+  best, best_q = 'application/json', 0.
+  for part in accept.split(','):
+    fields = part.strip().split(';')
+    mimetype, q = fields[0].strip().lower(), 1.
+    for param in fields[1:]:
+      name, _, value = param.strip().partition('=')
+      if name == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.
+    if mimetype in ('*/*', 'image/*'):
+      candidates = [m for m in offered if mimetype == '*/*' or m.startswith('image/')]
+    else:
+      candidates = [mimetype] if mimetype in offered else []
+    for candidate in candidates:
+      if q > best_q or (q == best_q and q > 0 and offered.index(candidate) < offered.index(best)):
+        best, best_q = candidate, q
+  return best
+
+def request_value(request, form, name, default, type):
+  value = form.get(name, request.query_params.get(name)) if form is not None else request.query_params.get(name)
+  if value is None:
+    return default
+  try:
+    return type(value)
+  except ValueError:
+    return default
+
+async def run_in_executor(waited, function, *args):
+  # the caller holds a slot, so a thread is free. `waited` is the time it waited for the slot
+  def job():
+    with metrics.collect() as timings:
+      metrics.record_timings([('queue', waited)], observe=False)
+      return function(*args), timings
+  return await asyncio.get_running_loop().run_in_executor(executor, job)
+
+def stylize_query(image_data, request_style_id, request_style_degree, ext, quality_flag, quality, deadline):
+  # runs on the executor, gives (status, encoded image or error message, meta)
+  key = service.cache_key(image_data, request_style_id, request_style_degree, ext, quality)
+  cached = service.cache.get(key)
+  if cached is not None:
+    return (200,) + cached
+  with metrics.stage_timer('decode'):
+    image = decode_received_image_data(image_data, service.max_image_size)
+  if image is None:
+    return 400, 'cannot decode image', None
+  image = image[:, :, [2, 1, 0]]  # BGR2RGB
+  result = service.stylize(image, request_style_id, request_style_degree, deadline)
+  if result is None:
+    return 422, 'no face detected', None
+  encoded_image, meta = service.encode_result(result, ext, quality_flag, quality)
+  service.cache.put(key, encoded_image, meta)
+  return 200, encoded_image, meta
+
+async def submit_query(request):
+  # admitted before the upload is read, same as the flask app
+  try:
+    async with admitted() as waited:
+      return await handle_query(request, waited)
+  except Overloaded as e:
+    return overloaded(str(e))
+
+async def handle_query(request, waited):
+  deadline = time.monotonic() + service.request_deadline_s
+  mimetype = best_match(request.headers.get('accept', ''))
+  ext, quality_flag = service.response_formats[mimetype]
+  quality = min(max(request_value(request, None, 'quality', service.response_quality, int), 1), 100)
+
+  form = await request.form()
+  try:
+    request_style_id = service.exstyles.lookup(request_value(request, form, 'style_id', service.style_id, str))
+  except KeyError as e:
+    return error(e.args[0], 400)
+  request_style_degree = min(max(request_value(request, form, 'style_degree', service.style_degree, float), 0.), 1.)
+  if 'image' not in form:
+    return error('missing image', 400)
+  image_data = await form['image'].read()
+  await form.close()
+
+  try:
+    (status_code, body, meta), timings = await run_in_executor(
+      waited, stylize_query, image_data, request_style_id, request_style_degree, ext, quality_flag, quality, deadline)
+  except TimeoutError as e:
+    return overloaded(str(e))
+  except ValueError as e:
+    return error(str(e), 400)
+
+  if status_code != 200:
+    response = error(body, status_code)
+  elif mimetype == 'application/json':
+    response = Response(json.dumps({
+      'format': 'img/jpeg',
+      'image': base64.b64encode(body).decode('utf-8')
+    }), media_type='application/json')
+  else:
+    response = Response(body, media_type=mimetype, headers={
+      'X-Crop-Box': ','.join(str(v) for v in meta['crop']),  # top,bottom,left,right
+      'X-Image-Size': ','.join(str(v) for v in meta['size']),  # height,width
+      'Vary': 'Accept',
+    })
+  if timings:
+    response.headers['Server-Timing'] = metrics.server_timing(timings)
+  return response
+
+async def submit_batch(request):
+  # the whole batch holds one slot, see AdmittedStreamingResponse
+  try:
+    waited = await acquire()
+  except Overloaded as e:
+    return overloaded(str(e))
+  try:
+    response = await handle_batch(request, waited)
+  except BaseException:
+    admission.release()
+    raise
+  if not isinstance(response, AdmittedStreamingResponse):
+    admission.release()
+  return response
+
+async def handle_batch(request, waited):
+  form = await request.form(max_files=service.max_batch_images + 1)
+  try:
+    request_style_id = service.exstyles.lookup(request_value(request, form, 'style_id', service.style_id, str))
+  except KeyError as e:
+    return error(e.args[0], 400)
+  request_style_degree = min(max(request_value(request, form, 'style_degree', service.style_degree, float), 0.), 1.)
+  quality = min(max(request_value(request, None, 'quality', service.response_quality, int), 1), 100)
+  ext, quality_flag = service.response_formats['image/jpeg']
+
+  if 'archive' in form:
+    try:
+      items = service.read_archive(await form['archive'].read())
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+      return error('cannot read archive: {}'.format(e), 400)
+  else:
+    items = [(f.filename, await f.read()) for f in form.getlist('images')]
+  await form.close()
+  if len(items) > service.max_batch_images:
+    return error('at most {} images per batch'.format(service.max_batch_images), 413)
+
+  pending, _ = await run_in_executor(waited, service.start_batch, items, request_style_id, request_style_degree, ext, quality)
+
+  async def generate():
+    # each line waits on the executor, the event loop only writes it out
+    loop = asyncio.get_running_loop()
+    for index, item in enumerate(pending):
+      yield await loop.run_in_executor(executor, service.finish_batch_item, index, *item, ext, quality_flag, quality)
+
+  return AdmittedStreamingResponse(generate(), media_type='application/x-ndjson')
+
+async def list_styles(request):
+  return Response(json.dumps({'default': service.exstyles.default, 'styles': service.exstyles.names}), media_type='application/json')
+
+async def batching_stats(request):
+  if service.batcher is None:
+    stats = {'num_workers': service.num_workers}
+  else:
+    stats = service.batcher.stats()
+    stats['face_detectors'] = service.face_detectors.stats()
+    stats['matting_sessions'] = service.rembg_simplify.sessions.stats()
+  stats['cache'] = service.cache.stats()
+  stats['admission'] = admission.stats()
+  return Response(json.dumps(stats), media_type='application/json')
+
+async def healthz(request):
+  state = service.readiness()
+  return Response(json.dumps(state), 200 if state['models_loaded'] else 503, media_type='application/json')
+
+async def readyz(request):
+  state = service.readiness()
+  return Response(json.dumps(state), 200 if state['models_loaded'] and state['warmed_up'] else 503, media_type='application/json')
+
+async def prometheus_metrics(request):
+  return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+def create_app():
+  routes = [
+    Route('/changeBg', submit_query, methods=['POST']),
+    Route('/changeBg/batch', submit_batch, methods=['POST']),
+    Route('/changeBg/styles', list_styles, methods=['GET']),
+    Route('/changeBg/stats', batching_stats, methods=['GET']),
+    Route('/healthz', healthz, methods=['GET']),
+    Route('/readyz', readyz, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+    Mount('/', StaticFiles(directory='./dist', html=True, check_dir=False)),
+  ]
+  middleware = [Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                           expose_headers=['Server-Timing', 'X-Crop-Box', 'X-Image-Size'])]
+  return Starlette(routes=routes, middleware=middleware)
+
+app = create_app()
+
+if __name__ == '__main__':
+  import uvicorn
+  uvicorn.run(app, host='0.0.0.0', port=8001)
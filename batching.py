@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import metrics
+
+
+def wait_result(future: Future, deadline: Optional[float] = None):
+    # future.result() until the time.monotonic deadline. gives the builtin TimeoutError, before
+    # python 3.11 concurrent.futures has its own
+    try:
+        return future.result(timeout=None if deadline is None else max(deadline - time.monotonic(), 0.))
+    except FutureTimeoutError:
+        if future.done():
+            raise
+        raise TimeoutError('deadline exceeded while waiting for the result') from None
+
+
+class MicroBatcher():
+    '''
+    Collects crops from concurrent requests and runs them through the models as one batch.
+
+    A batch is closed when `max_batch_size` items are queued or `max_wait_ms` has passed since
+    its first item arrived. Crops are bucketed by shape instead of padded, because the instance
+    norms in VToonify would see the padding and change the result. Each crop carries its own
+    style id, while the style degree is part of the bucket since it is one scalar per forward.
+    Items whose deadline (time.monotonic) has passed while queued fail with TimeoutError.
+    '''
+    def __init__(self,
+                 run_batch: Callable[[List[np.ndarray], List[int], float], List[np.ndarray]],
+                 max_batch_size: int = 4,
+                 max_wait_ms: float = 20):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._num_items = 0
+        self._num_batches = 0
+        self._max_queue_depth = 0
+
+        self._worker = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, crop: np.ndarray, style_id: int, style_degree: float, deadline: Optional[float] = None) -> Future:
+        future = Future()
+        self.queue.put((crop, style_id, style_degree, deadline, future))
+        with self._lock:
+            self._max_queue_depth = max(self._max_queue_depth, self.queue.qsize())
+        return future
+
+    def __call__(self, crop: np.ndarray, style_id: int, style_degree: float, deadline: Optional[float] = None) -> np.ndarray:
+        future = self.submit(crop, style_id, style_degree, deadline)
+        output = wait_result(future, deadline)
+        # the stages of the batch were observed on the batcher thread, attribute them to this request too
+        metrics.record_timings(future.timings, observe=False)
+        return output
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self._max_queue_depth,
+                'num_items': self._num_items,
+                'num_batches': self._num_batches,
+                'mean_batch_size': self._num_items / max(self._num_batches, 1),
+                'batch_sizes': {str(k): v for k, v in sorted(self._batch_sizes.items())},
+            }
+
+    def _collect(self) -> List:
+        items = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _loop(self):
+        # nothing may end this thread, every later submit would wait forever. whatever fails
+        # fails the futures of its round (or bucket) only
+        while True:
+            collected = []
+            try:
+                collected = self._collect()
+                buckets = defaultdict(list)
+                now = time.monotonic()
+                for crop, style_id, style_degree, deadline, future in collected:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    if deadline is not None and now > deadline:
+                        future.set_exception(TimeoutError('deadline exceeded while waiting for a batch'))
+                        continue
+                    buckets[crop.shape, style_degree].append((crop, style_id, future))
+            except Exception as e:
+                self._fail([future for *_, future in collected], e)
+                continue
+
+            for (_, style_degree), items in buckets.items():
+                try:
+                    self._run(items, style_degree)
+                except Exception as e:
+                    self._fail([future for _, _, future in items], e)
+
+    def _run(self, items: List, style_degree: float):
+        crops = [crop for crop, _, _ in items]
+        style_ids = [style_id for _, style_id, _ in items]
+        with metrics.collect() as timings:
+            outputs = self.run_batch(crops, style_ids, style_degree)
+        if len(outputs) != len(items):
+            raise RuntimeError('run_batch gave {} outputs for {} crops'.format(len(outputs), len(items)))
+        for (_, _, future), output in zip(items, outputs):
+            future.timings = timings
+            future.set_result(output)
+
+        with self._lock:
+            self._batch_sizes[len(items)] += 1
+            self._num_items += len(items)
+            self._num_batches += 1
+
+    @staticmethod
+    def _fail(futures: List[Future], e: Exception):
+        for future in futures:
+            if not future.done():
+                future.set_exception(e)
@@ -1,14 +1,23 @@
 from pathlib import Path
-import json, base64, hashlib
-from flask import Blueprint, request
+import os, json, base64, hashlib, threading, time, io, tarfile, zipfile
+import cv2
+from flask import Blueprint, Response, make_response, request, stream_with_context
 from flask_cors import cross_origin
 # from backend.matting.rembg_simplify import get_background_mask
 # from backend.generativemodels.inpaint import create_inpaint_pipeline
 # from backend.generativemodels.inpaint import inpaint
-from style_transfer import create_image_style_transfer_dualstylegan_models, image_style_transfer_dualstylegan
-from util import encode_image_to_bytes, decode_received_image_data
+from style_transfer import create_image_style_transfer_dualstylegan_models, preprocess_frame, stylize_crops, blending, warmup_image_style_transfer_dualstylegan
+from batching import MicroBatcher, wait_result
+from worker_pool import WorkerPool
+from result_cache import ResultCache
+from admission import AdmissionController, Overloaded
+from resource_pool import ResourcePool
+from matting import rembg_simplify
+from model_store import ModelStore
+from onnx_backend import onnx_path
+import metrics
+from util import encode_image_to_bytes, decode_received_image_data, new_face_detector
 from server_config import config
-from mediapipe.python.solutions.face_detection import FaceDetection
 
 bp = Blueprint('changeBg', __name__, url_prefix='/changeBg')
 
@@ -16,18 +25,336 @@ ckpt_dir = config['ckpt_dir']
 style_id = config['style_id']
 device = config['device']
 padding = config['padding']
+max_batch_size = config.get('max_batch_size', 4)
+max_batch_wait_ms = config.get('max_batch_wait_ms', 20)
+num_workers = config.get('num_workers', 0)
+worker_threads = config.get('worker_threads', 1)
+# defaults, each request may pick its own style_id (index or name) and style_degree
+style_degree = config.get('style_degree', 0.5)
+# quality of the encoded response, the client may lower it per request with ?quality=
+response_quality = config.get('response_quality', 90)
+response_formats = {
+  'application/json': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),  # legacy base64-in-json
+  'image/jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+  'image/webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+}
 
-models = create_image_style_transfer_dualstylegan_models(style_id, device)
-faceDetector = FaceDetection()
+# crop sizes pushed through the pipeline before the server reports ready,
+# an unclipped face crop is 2 * padding on each side
+warmup_sizes = [tuple(size) for size in config.get('warmup_sizes', [[2 * padding // 8 * 8, 2 * padding // 8 * 8]])]
+status = {'models_loaded': False, 'warmed_up': False, 'warm_latency_ms': None, 'load_ms': {}, 'started_at': time.time()}
+
+# at most max_concurrency requests run, max_queue wait, the rest get a 503 before the upload is read
+admission = AdmissionController(config.get('max_concurrency', 4), config.get('max_queue', 16),
+                                config.get('queue_timeout_s', 10), config.get('retry_after_s', 1))
+request_deadline_s = config.get('request_deadline_s', 30)
+# preprocess_frame shrinks everything to this longest edge, large jpegs are decoded at reduced scale straight away
+max_image_size = 1024
+# upper bound of images in one /changeBg/batch request
+max_batch_images = config.get('max_batch_images', 64)
+
+# mediapipe graphs and onnxruntime sessions are not shared between threads, each request checks one out
+detector_pool_size = config.get('detector_pool_size', admission.max_concurrency)
+matting_pool_size = config.get('matting_pool_size', 2)
+
+cache = ResultCache(config.get('cache_entries', 256), config.get('cache_dir'), config.get('cache_disk_bytes', 1 << 30))
+
+# every model file is resolved (and checked against the manifest of model_dir) before anything is loaded.
+# offline, a file that is not in model_dir is an error instead of a download
+model_store = ModelStore(config.get('model_dir', './checkpoint'), config.get('offline', False),
+                         fetch=lambda name: str(rembg_simplify.model_file()[0]) if name == 'u2net.onnx' else None,
+                         verify=config.get('verify_models', True), workers=config.get('load_workers', 4))
+model_names = {'matting': 'u2net.onnx'}
+backend = config.get('backend', 'torch')
+if config.get('bundle') is None:
+  model_names.update(ckpt='{}/{}'.format(ckpt_dir, config.get('ckpt_name', 'vtoonify_s{:03d}_d0.5.pt'.format(style_id))),
+                     faceparsing_ckpt='faceparsing.pth', pspencoder_ckpt='encoder.pt',
+                     exstyle_path='{}/exstyle_code.npy'.format(ckpt_dir))
+  if backend == 'onnx':
+    # exported by onnx_backend.py next to the checkpoints
+    model_names.update(vtoonify_onnx=onnx_path(model_names['ckpt']), faceparsing_onnx='faceparsing.onnx',
+                       pspencoder_onnx='encoder.onnx')
+model_paths = model_store.resolve_all(model_names.values())
+for name in model_store.unverified():
+  print('{} is not in the model manifest, used unverified'.format(name))
+rembg_simplify.default_model_path = model_paths[model_names.pop('matting')]
+
+models = create_image_style_transfer_dualstylegan_models(style_id, device, bundle=config.get('bundle'),
+                                                         use_stored_wplus=config.get('use_stored_wplus', False),
+                                                         load_times=status['load_ms'], max_workers=config.get('load_workers', 4),
+                                                         lean=config.get('lean_inference', True), backend=backend,
+                                                         **{arg: model_paths[name] for arg, name in model_names.items()})
+backbone_path = getattr(models[0], 'backbone_path', None)
+if backbone_path is not None:
+  # a delta checkpoint was composed with this backbone file. which one is only known once the delta
+  # is read, so it is checked against the manifest now, still before anything is served
+  backbone_name = os.path.relpath(backbone_path, model_store.root)
+  model_paths[backbone_name] = model_store.resolve(backbone_name)
+  if backbone_name in model_store.unverified():
+    print('{} is not in the model manifest, used unverified'.format(backbone_name))
+if num_workers > 0:
+  # detection, inference and blending all run inside the forked workers
+  pool = WorkerPool(models, device, num_workers, worker_threads, warmup_sizes)
+  batcher = None
+else:
+  pool = None
+  face_detectors = ResourcePool(new_face_detector, detector_pool_size, 'face detector')
+  rembg_simplify.sessions.resize(matting_pool_size)
+  batcher = MicroBatcher(lambda crops, style_ids, degree: stylize_crops(crops, device, models, degree, style_ids),
+                         max_batch_size, max_batch_wait_ms)
+exstyles = models[3]
+status['models_loaded'] = True
+
+def file_version(name, path):
+  # the manifest digest, or size and mtime for a file the manifest does not list
+  entry = model_store.manifest.get(name)
+  if entry is not None:
+    return entry['sha256']
+  stat = os.stat(path)
+  return [stat.st_size, stat.st_mtime_ns]
+
+# identifies the loaded models in the result cache keys. the disk tier outlives a restart, a
+# different checkpoint, backbone, bundle or backend must not be served its results
+model_files = dict(model_paths)
+if config.get('bundle') is not None:
+  model_files[config['bundle']] = config['bundle']
+model_version = hashlib.sha256(json.dumps(
+  [backend, sorted([path, file_version(name, path)] for name, path in model_files.items())]).encode('utf-8')).hexdigest()
+
+def warmup():
+  with face_detectors.checkout() as faceDetector:
+    latency = warmup_image_style_transfer_dualstylegan(device, models, warmup_sizes, faceDetector)
+  status.update(warmed_up=True, warm_latency_ms=latency)
+
+if pool is None:
+  # warm up in the background, /readyz keeps failing until it is done
+  threading.Thread(target=warmup, name='warmup', daemon=True).start()
+
+def readiness():
+  if pool is not None and pool.warmed_up and not status['warmed_up']:
+    status.update(warmed_up=True, warm_latency_ms=pool.warm_latency)
+  return dict(status)
+
+def cache_key(image_data, request_style_id, request_style_degree, ext, quality):
+  # everything that changes the output has to be part of the key
+  digest = hashlib.sha256(image_data)
+  digest.update(json.dumps([model_version, request_style_id, padding, request_style_degree, ext, quality]).encode('utf-8'))
+  return digest.hexdigest()
+
+def start_stylize(image, request_style_id, request_style_degree, deadline):
+  # queues the image and returns a function that waits for it,
+  # which gives the blended image and the (top, bottom, left, right) box that was stylized
+  if pool is not None:
+    future = pool.submit(image, [padding for _ in range(4)], request_style_id, request_style_degree, deadline)
+    def finish():
+      result = wait_result(future, deadline)
+      metrics.record_timings(future.timings)
+      return result
+    return finish
+
+  with face_detectors.checkout() as faceDetector:
+    prepared = preprocess_frame(image, [padding for _ in range(4)], faceDetector)
+  if prepared is None:
+    return lambda: None
+  origin, crop, box = prepared
+  future = batcher.submit(crop, request_style_id, request_style_degree, deadline)
+  def finish():
+    output = wait_result(future, deadline)
+    metrics.record_timings(future.timings, observe=False)
+    return blending(origin, output, *box), box
+  return finish
+
+def batch_deadline(index):
+  # the deadline of the index-th image of a batch, taken when it is queued: request_deadline_s for
+  # every max_batch_size images up to and including it, since the batch is worked through in order
+  return time.monotonic() + request_deadline_s * (1 + index // max_batch_size)
+
+def stylize(image, request_style_id, request_style_degree, deadline):
+  return start_stylize(image, request_style_id, request_style_degree, deadline)()
+
+def encode_result(result, ext, quality_flag, quality):
+  new_img, (top, bottom, left, right) = result
+  new_img = new_img[:, :, [2, 1, 0]] # RGB2BGR
+  with metrics.stage_timer('encode'):
+    encoded_image = encode_image_to_bytes(ext, new_img, [quality_flag, quality])
+  meta = {'crop': [top, bottom, left, right], 'size': [new_img.shape[0], new_img.shape[1]]}
+  return encoded_image, meta
 
 @bp.route('', methods=('POST', ))
-@cross_origin()
+@cross_origin(expose_headers=['Server-Timing', 'X-Crop-Box', 'X-Image-Size'])
 def submit_query():
+  deadline = time.monotonic() + request_deadline_s
+  with metrics.collect() as timings:
+    try:
+      with admission.admit():
+        response = make_response(handle_query(deadline))
+    except Overloaded as e:
+      response = make_response(json.dumps({'error': str(e)}), 503)
+      response.headers['Retry-After'] = str(e.retry_after)
+    except TimeoutError as e:
+      response = make_response(json.dumps({'error': str(e)}), 503)
+      response.headers['Retry-After'] = str(admission.retry_after)
+    except ValueError as e:
+      # the input could not be stylized, raised in process or passed on by a worker
+      response = make_response(json.dumps({'error': str(e)}), 400)
+  if timings:
+    response.headers['Server-Timing'] = metrics.server_timing(timings)
+  return response
+
+def handle_query(deadline):
+  # json stays first so that clients sending */* keep getting the legacy response
+  mimetype = request.accept_mimetypes.best_match(list(response_formats), default='application/json')
+  ext, quality_flag = response_formats[mimetype]
+  quality = min(max(request.args.get('quality', response_quality, type=int), 1), 100)
+  try:
+    request_style_id = exstyles.lookup(request.values.get('style_id', style_id))
+  except KeyError as e:
+    return json.dumps({'error': e.args[0]}), 400
+  request_style_degree = min(max(request.values.get('style_degree', style_degree, type=float), 0.), 1.)
+
   image_data = request.files['image'].read()
-  image = decode_received_image_data(image_data)[:, :, [2, 1, 0]]  # BGR2RGB
-  new_img = image_style_transfer_dualstylegan(image, style_id, device, [padding for _ in range(4)], faceDetector, models)[:, :, [2, 1, 0]] # RGB2BGR
-  encoded_image = encode_image_to_bytes('.jpg', new_img)
-  return json.dumps({
-    'format': 'img/jpeg',
-    'image': base64.b64encode(encoded_image).decode('utf-8')
-  })
+  key = cache_key(image_data, request_style_id, request_style_degree, ext, quality)
+  cached = cache.get(key)
+  if cached is None:
+    with metrics.stage_timer('decode'):
+      image = decode_received_image_data(image_data, max_image_size)
+    if image is None:
+      return json.dumps({'error': 'cannot decode image'}), 400
+    image = image[:, :, [2, 1, 0]]  # BGR2RGB
+    result = stylize(image, request_style_id, request_style_degree, deadline)
+    if result is None:
+      return json.dumps({'error': 'no face detected'}), 422
+    encoded_image, meta = encode_result(result, ext, quality_flag, quality)
+    cache.put(key, encoded_image, meta)
+  else:
+    encoded_image, meta = cached
+
+  if mimetype == 'application/json':
+    return json.dumps({
+      'format': 'img/jpeg',
+      'image': base64.b64encode(encoded_image).decode('utf-8')
+    })
+  response = Response(encoded_image, mimetype=mimetype)
+  response.headers['X-Crop-Box'] = ','.join(str(v) for v in meta['crop'])  # top,bottom,left,right
+  response.headers['X-Image-Size'] = ','.join(str(v) for v in meta['size'])  # height,width
+  response.headers['Vary'] = 'Accept'
+  return response
+
+def read_batch_images():
+  # either several 'images' files in a multipart upload, or one zip/tar 'archive'
+  if 'archive' not in request.files:
+    return [(f.filename, f.read()) for f in request.files.getlist('images')]
+  return read_archive(request.files['archive'].read())
+
+def read_archive(data):
+  # (name, bytes) of every file in a zip or tar archive
+  archive = io.BytesIO(data)
+  if zipfile.is_zipfile(archive):
+    with zipfile.ZipFile(archive) as z:
+      return [(info.filename, z.read(info)) for info in z.infolist() if not info.is_dir()]
+  archive.seek(0)
+  with tarfile.open(fileobj=archive) as t:
+    return [(member.name, t.extractfile(member).read()) for member in t.getmembers() if member.isfile()]
+
+@bp.route('/batch', methods=('POST', ))
+@cross_origin()
+def submit_batch():
+  '''
+  Stylizes many images in one request. Detection runs per image as it is read, all crops are
+  queued at once so that the batcher (or the worker pool) can process them together, and the
+  results are streamed back as newline-delimited json, in upload order, as soon as they are done.
+  Every image has its own deadline, see batch_deadline.
+  '''
+  # the whole batch holds one slot, released once the response is closed. admitted before the
+  # form is read, request.values parses the whole upload
+  try:
+    admission.acquire()
+  except Overloaded as e:
+    return json.dumps({'error': str(e)}), 503, {'Retry-After': str(e.retry_after)}
+
+  try:
+    try:
+      request_style_id = exstyles.lookup(request.values.get('style_id', style_id))
+    except KeyError as e:
+      admission.release()
+      return json.dumps({'error': e.args[0]}), 400
+    request_style_degree = min(max(request.values.get('style_degree', style_degree, type=float), 0.), 1.)
+    quality = min(max(request.args.get('quality', response_quality, type=int), 1), 100)
+    ext, quality_flag = response_formats['image/jpeg']
+
+    try:
+      items = read_batch_images()
+    except (tarfile.TarError, zipfile.BadZipFile) as e:
+      admission.release()
+      return json.dumps({'error': 'cannot read archive: {}'.format(e)}), 400
+    if len(items) > max_batch_images:
+      admission.release()
+      return json.dumps({'error': 'at most {} images per batch'.format(max_batch_images)}), 413
+
+    pending = start_batch(items, request_style_id, request_style_degree, ext, quality)
+  except Exception:
+    admission.release()
+    raise
+
+  def generate():
+    for index, item in enumerate(pending):
+      yield finish_batch_item(index, *item, ext, quality_flag, quality)
+
+  # the server closes the response also when the client went away before the stream was started,
+  # a finally in generate would not run then
+  response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+  response.call_on_close(admission.release)
+  return response
+
+def start_batch(items, request_style_id, request_style_degree, ext, quality):
+  # decodes every image and queues it, each with its own deadline. gives (name, cache key, cached
+  # result, finish) per image, finish is None for an image that cannot be decoded
+  pending = []
+  for index, (name, image_data) in enumerate(items):
+    key = cache_key(image_data, request_style_id, request_style_degree, ext, quality)
+    cached = cache.get(key)
+    if cached is not None:
+      pending.append((name, key, cached, None))
+      continue
+    image = decode_received_image_data(image_data, max_image_size)
+    if image is None:
+      pending.append((name, key, None, None))
+      continue
+    pending.append((name, key, None, start_stylize(image[:, :, [2, 1, 0]], request_style_id, request_style_degree,
+                                                   batch_deadline(index))))
+  return pending
+
+def finish_batch_item(index, name, key, cached, finish, ext, quality_flag, quality):
+  # waits for one image of start_batch and gives its line of the ndjson stream
+  line = {'index': index, 'name': name}
+  try:
+    if cached is not None:
+      encoded_image, meta = cached
+    elif finish is None:
+      raise ValueError('cannot decode image')
+    else:
+      result = finish()
+      if result is None:
+        raise ValueError('no face detected')
+      encoded_image, meta = encode_result(result, ext, quality_flag, quality)
+      cache.put(key, encoded_image, meta)
+    line.update(meta, format='img/jpeg', image=base64.b64encode(encoded_image).decode('utf-8'))
+  except (ValueError, TimeoutError, RuntimeError) as e:
+    line['error'] = str(e)
+  return json.dumps(line) + '\n'
+
+@bp.route('/styles', methods=('GET', ))
+def list_styles():
+  return json.dumps({'default': exstyles.default, 'styles': exstyles.names})
+
+@bp.route('/stats', methods=('GET', ))
+def batching_stats():
+  if batcher is None:
+    stats = {'num_workers': num_workers}
+  else:
+    stats = batcher.stats()
+    stats['face_detectors'] = face_detectors.stats()
+    stats['matting_sessions'] = rembg_simplify.sessions.stats()
+  stats['cache'] = cache.stats()
+  stats['admission'] = admission.stats()
+  return json.dumps(stats)
@@ -0,0 +1,22 @@
+import json
+from flask import Blueprint, Response
+from bp.anime_style_transfer import readiness
+import metrics
+
+bp = Blueprint('health', __name__)
+
+@bp.route('/healthz', methods=('GET', ))
+def healthz():
+  # liveness, the process is up and the models are in memory
+  state = readiness()
+  return json.dumps(state), 200 if state['models_loaded'] else 503
+
+@bp.route('/readyz', methods=('GET', ))
+def readyz():
+  # readiness, the warm-up has gone through the full pipeline
+  state = readiness()
+  return json.dumps(state), 200 if state['models_loaded'] and state['warmed_up'] else 503
+
+@bp.route('/metrics', methods=('GET', ))
+def prometheus_metrics():
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,138 @@
+import os
+import hashlib
+import argparse
+from typing import Dict, Optional, Tuple
+
+import torch
+
+# only these parts of VToonify are trained, the DualStyleGAN/StyleGAN generator and the ModRes
+# blocks stay frozen and are the same for every style trained on top of one backbone
+TRAINABLE_PREFIXES = ('encoder.', 'fusion_out.', 'fusion_skip.')
+FORMAT = 'vtoonify-delta-1'
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Convert VToonify Checkpoints into Deltas on a Shared Backbone")
+        self.parser.add_argument("ckpts", type=str, nargs='+', help="full vtoonify checkpoints, e.g. checkpoint/vtoonify_d_cartoon/*.pt")
+        self.parser.add_argument("--backbone_dir", type=str, default=None, help="where the backbone files go, next to each checkpoint by default")
+        self.parser.add_argument("--suffix", type=str, default='_delta', help="the delta of x.pt is saved as x{suffix}.pt")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+
+def split_state_dict(state_dict: Dict[str, torch.Tensor]) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+    delta = {k: v for k, v in state_dict.items() if k.startswith(TRAINABLE_PREFIXES)}
+    backbone = {k: v for k, v in state_dict.items() if not k.startswith(TRAINABLE_PREFIXES)}
+    return delta, backbone
+
+
+def backbone_fingerprint(backbone: Dict[str, torch.Tensor]) -> str:
+    # sha256 of the names, dtypes, shapes and bytes of every frozen tensor
+    digest = hashlib.sha256()
+    for name in sorted(backbone):
+        array = backbone[name].detach().cpu().contiguous().numpy()
+        digest.update('{}:{}:{}'.format(name, array.dtype.str, array.shape).encode('utf-8'))
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+def backbone_filename(fingerprint: str) -> str:
+    return 'backbone_{}.pt'.format(fingerprint[:16])
+
+
+def save_backbone(directory: str, backbone: Dict[str, torch.Tensor], fingerprint: str, arch: str,
+                  pruned: bool = False) -> str:
+    # written once per backbone, every delta in the directory refers to it by name
+    path = os.path.join(directory, backbone_filename(fingerprint))
+    if not os.path.exists(path):
+        tmp_path = path + '.tmp'
+        torch.save({'format': FORMAT, 'backbone': arch, 'fingerprint': fingerprint, 'pruned': pruned,
+                    'g_ema_backbone': {k: v.detach().cpu() for k, v in backbone.items()}}, tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+
+def save_delta(path: str, state_dict: Dict[str, torch.Tensor], fingerprint: str, arch: str,
+               backbone_path: Optional[str] = None):
+    # state_dict may be the whole g_ema state, only the trainable part is kept
+    delta, _ = split_state_dict(state_dict)
+    torch.save({
+        'format': FORMAT,
+        'backbone': arch,
+        'backbone_fingerprint': fingerprint,
+        # relative to the delta, so that the two can be moved together
+        'backbone_file': os.path.relpath(backbone_path, os.path.dirname(os.path.abspath(path)))
+                         if backbone_path is not None else backbone_filename(fingerprint),
+        'g_ema_delta': {k: v.detach().cpu() for k, v in delta.items()},
+    }, path)
+
+
+def read_vtoonify_checkpoint(path: str, backbone_path: Optional[str] = None, map_location='cpu'
+                             ) -> Tuple[Dict[str, torch.Tensor], bool, Optional[str]]:
+    '''
+    The full g_ema state dict of a vtoonify checkpoint, whether it was saved whole or as a delta,
+    whether it was saved by prune_vtoonify.py and, for a delta, the path of its backbone file.
+
+    A delta is composed with its backbone file, found next to it unless `backbone_path` is given,
+    and refused when the fingerprints of the two do not match.
+    '''
+    ckpt = torch.load(path, map_location=map_location)
+    if 'g_ema' in ckpt:
+        return ckpt['g_ema'], ckpt.get('pruned', False), None
+    if ckpt.get('format') != FORMAT:
+        raise ValueError('{} is neither a vtoonify checkpoint nor a delta'.format(path))
+
+    if backbone_path is None:
+        backbone_path = os.path.join(os.path.dirname(path), ckpt['backbone_file'])
+    backbone = torch.load(backbone_path, map_location=map_location)
+    if backbone['fingerprint'] != ckpt['backbone_fingerprint']:
+        raise ValueError('{} was trained on backbone {}, but {} is {}'.format(
+            path, ckpt['backbone_fingerprint'][:16], backbone_path, backbone['fingerprint'][:16]))
+    state_dict = dict(backbone['g_ema_backbone'])
+    state_dict.update(ckpt['g_ema_delta'])
+    return state_dict, backbone.get('pruned', False), backbone_path
+
+
+def load_vtoonify_state(path: str, backbone_path: Optional[str] = None, map_location='cpu') -> Dict[str, torch.Tensor]:
+    return read_vtoonify_checkpoint(path, backbone_path, map_location)[0]
+
+
+def load_vtoonify(vtoonify, path: str, backbone_path: Optional[str] = None, map_location='cpu'):
+    # loads any vtoonify checkpoint into vtoonify, which is pruned first if the checkpoint was.
+    # the backbone file of a delta is kept as vtoonify.backbone_path, the weights depend on it too
+    state_dict, pruned, vtoonify.backbone_path = read_vtoonify_checkpoint(path, backbone_path, map_location)
+    if pruned and not vtoonify.pruned:
+        vtoonify.prune_for_inference()
+    vtoonify.load_state_dict(state_dict)
+    return vtoonify
+
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    for ckpt_path in args.ckpts:
+        ckpt = torch.load(ckpt_path, map_location='cpu')
+        if 'g_ema' not in ckpt:
+            print('skip {}, not a full checkpoint'.format(ckpt_path))
+            continue
+        delta, backbone = split_state_dict(ckpt['g_ema'])
+        # a checkpoint without res.* blocks was trained on the toonify backbone
+        arch = 'dualstylegan' if any(k.startswith('res.') for k in backbone) else 'toonify'
+        fingerprint = backbone_fingerprint(backbone)
+        directory = args.backbone_dir or os.path.dirname(ckpt_path)
+        backbone_path = save_backbone(directory, backbone, fingerprint, arch, ckpt.get('pruned', False))
+        delta_path = os.path.splitext(ckpt_path)[0] + args.suffix + '.pt'
+        save_delta(delta_path, delta, fingerprint, arch, backbone_path)
+
+        # the composed state has to be exactly the original one
+        composed = load_vtoonify_state(delta_path, backbone_path)
+        assert composed.keys() == ckpt['g_ema'].keys() and all(torch.equal(composed[k], v) for k, v in ckpt['g_ema'].items())
+        print('{}: {:.1f} MB -> {:.1f} MB delta on {} ({:.1f} MB)'.format(
+            ckpt_path, os.path.getsize(ckpt_path) / 2**20, os.path.getsize(delta_path) / 2**20,
+            backbone_path, os.path.getsize(backbone_path) / 2**20))
@@ -0,0 +1,145 @@
+import os
+import json
+import argparse
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+# exstyle_code.npy is a pickled {name: (1, 18, 512) z+ code} dict. The compact store next to it is
+#   exstyle_code.codes.npy   (n_styles, 18, 512) float32 z+ codes, in the order of the dict
+#   exstyle_code.names.json  the style names (and how the W+ table was made), and the size and
+#                            mtime of exstyle_code.npy when the store was written
+#   exstyle_code.wplus.npy   optional, the codes after zplus2wplus, float16 by default
+# all arrays are opened with mmap_mode='r', so picking one style reads 36KB instead of the whole file
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Convert exstyle_code.npy into a Compact Store")
+        self.parser.add_argument("--exstyle_path", type=str, default='./checkpoint/vtoonify_d_cartoon/exstyle_code.npy', help="path of the pickled extrinsic style code")
+        self.parser.add_argument("--ckpt", type=str, default=None, help="vtoonify checkpoint to also store the W+ codes with")
+        self.parser.add_argument("--wplus_dtype", type=str, default='float16', help="float16 | float32, dtype of the stored W+ codes")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+
+def store_paths(exstyle_path: str) -> Tuple[str, str, str]:
+    stem = os.path.splitext(exstyle_path)[0]
+    return stem + '.codes.npy', stem + '.names.json', stem + '.wplus.npy'
+
+
+def _source_stat(path: str) -> Optional[List[int]]:
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _save_atomic(path: str, save):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        save(f)
+    os.replace(tmp_path, path)
+
+
+class ExstyleStore():
+    '''
+    The extrinsic style codes of a checkpoint as one (n_styles, 18, 512) array plus a name index.
+
+    Opens the compact store when it is there and falls back to unpickling exstyle_code.npy.
+    '''
+    def __init__(self, codes: np.ndarray, names: List[str], wplus: Optional[np.ndarray] = None, info: Optional[Dict] = None):
+        self.codes = codes
+        self.names = names
+        self.wplus = wplus
+        self.info = info or {}
+        self.index: Dict[str, int] = {name: i for i, name in enumerate(names)}
+
+    @classmethod
+    def open(cls, exstyle_path: str) -> 'ExstyleStore':
+        codes_path, names_path, wplus_path = store_paths(exstyle_path)
+        info = None
+        if os.path.exists(codes_path) and os.path.exists(names_path):
+            with open(names_path) as f:
+                info = json.load(f)
+            # a pickled dict that was replaced after the conversion wins over the stale store
+            source = info.pop('source_stat', None)
+            if source is None:
+                # written before the stat was recorded
+                stale = os.path.exists(exstyle_path) and os.path.getmtime(exstyle_path) > os.path.getmtime(names_path)
+            else:
+                stale = _source_stat(exstyle_path) not in (None, source)
+            if stale:
+                info = None
+        if info is not None:
+            codes = np.load(codes_path, mmap_mode='r')
+            wplus = np.load(wplus_path, mmap_mode='r') if os.path.exists(wplus_path) else None
+            return cls(codes, info.pop('names'), wplus, info)
+
+        exstyles = np.load(exstyle_path, allow_pickle=True).item()
+        names = list(exstyles.keys())
+        codes = np.concatenate([np.asarray(exstyles[name], dtype=np.float32).reshape(1, 18, 512) for name in names], axis=0)
+        return cls(codes, names)
+
+    def lookup(self, style: Union[int, str]) -> int:
+        if isinstance(style, str) and style in self.index:
+            return self.index[style]
+        try:
+            style_id = int(style)
+        except ValueError:
+            raise KeyError('unknown style {}'.format(style))
+        if not 0 <= style_id < len(self.names):
+            raise KeyError('style id {} out of range [0, {})'.format(style_id, len(self.names)))
+        return style_id
+
+    def zplus(self, style: Union[int, str]) -> np.ndarray:
+        # (1, 18, 512), the same as exstyles[list(exstyles.keys())[style_id]] used to give
+        style_id = self.lookup(style)
+        return np.array(self.codes[style_id:style_id+1])
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def save(self, exstyle_path: str, legacy: bool = True):
+        # writes the compact store, and the pickled dict as well for code that still reads that
+        codes_path, names_path, wplus_path = store_paths(exstyle_path)
+        # the pickled dict first, the names record what it looks like once it is written
+        if legacy:
+            _save_atomic(exstyle_path, lambda f: np.save(f, {name: self.zplus(i) for i, name in enumerate(self.names)}, allow_pickle=True))
+        _save_atomic(codes_path, lambda f: np.save(f, np.ascontiguousarray(self.codes, dtype=np.float32)))
+        if self.wplus is not None:
+            _save_atomic(wplus_path, lambda f: np.save(f, np.ascontiguousarray(self.wplus)))
+        # names last, a reader only picks the store up once it is complete
+        info = dict(self.info, names=self.names, source_stat=_source_stat(exstyle_path))
+        _save_atomic(names_path, lambda f: f.write(json.dumps(info).encode('utf-8')))
+
+    def add_wplus(self, vtoonify, dtype: str = 'float16', source: Optional[str] = None, batch_size: int = 64):
+        # W+ only depends on the mapping network of the (frozen) StyleGAN, `source` records which one
+        device = next(vtoonify.parameters()).device
+        wplus = []
+        with torch.no_grad():
+            for start in range(0, len(self), batch_size):
+                zplus = torch.from_numpy(np.array(self.codes[start:start+batch_size])).to(device)
+                wplus.append(vtoonify.zplus2wplus(zplus).cpu().numpy())
+        self.wplus = np.concatenate(wplus, axis=0).astype(dtype)
+        self.info = dict(self.info, wplus_dtype=dtype, wplus_source=source)
+
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    store = ExstyleStore.open(args.exstyle_path)
+    if args.ckpt is not None:
+        from model.vtoonify import VToonify
+        vtoonify = VToonify(backbone='dualstylegan')
+        from delta_checkpoint import load_vtoonify
+        load_vtoonify(vtoonify, args.ckpt)
+        store.add_wplus(vtoonify.eval(), args.wplus_dtype, os.path.basename(args.ckpt))
+    store.save(args.exstyle_path, legacy=False)
+    print('saved {} styles next to {}'.format(len(store), args.exstyle_path))
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+from collections import defaultdict
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Import Time Report of the Serving Modules")
+        self.parser.add_argument("--modules", type=str, nargs='+',
+                                 default=['style_transfer', 'util', 'matting.rembg_simplify', 'batching', 'worker_pool', 'result_cache', 'metrics'],
+                                 help="modules to import, each one in a fresh interpreter")
+        self.parser.add_argument("--repeat", type=int, default=3, help="imports per module, the median is reported")
+        self.parser.add_argument("--top", type=int, default=10, help="number of the most expensive packages listed per module")
+        self.parser.add_argument("--forbid", type=str, nargs='*',
+                                 default=['matplotlib', 'mediapipe', 'torchvision', 'onnxruntime', 'pooch', 'dlib'],
+                                 help="packages that must not be imported eagerly")
+        self.parser.add_argument("--budget_ms", type=float, default=None, help="fail when a module takes longer than this to import")
+        self.parser.add_argument("--output", type=str, default=None, help="also write the json report to this path")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+def import_times(module):
+    # runs `python -X importtime -c "import module"` and returns {imported module: (self us, cumulative us)}
+    statement = 'import {}'.format(module) if module else 'pass'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, result.stderr.strip().splitlines()[-1]))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def report_module(module, repeat, top, forbid, startup):
+    # modules the interpreter imports on its own (site, encodings, ...) are left out
+    runs = [{name: t for name, t in import_times(module).items() if name not in startup} for _ in range(repeat)]
+    # the median run by total time, so that the per package numbers belong to one consistent run
+    runs.sort(key=lambda times: times[module][1])
+    times = runs[len(runs) // 2]
+
+    packages = defaultdict(int)
+    for name, (self_us, _) in times.items():
+        packages[name.split('.')[0]] += self_us
+    heaviest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return {
+        'total_ms': times[module][1] / 1000,
+        'total_ms_min': runs[0][module][1] / 1000,
+        'num_modules': len(times),
+        'packages_ms': {name: us / 1000 for name, us in heaviest},
+        'forbidden': sorted(set(packages) & set(forbid)),
+    }
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    startup = set(import_times(None))
+    report = {}
+    failed = []
+    for module in args.modules:
+        try:
+            report[module] = report_module(module, args.repeat, args.top, args.forbid, startup)
+        except RuntimeError as e:
+            report[module] = {'error': str(e)}
+            failed.append(module)
+            continue
+        if report[module]['forbidden']:
+            failed.append(module)
+        if args.budget_ms is not None and report[module]['total_ms'] > args.budget_ms:
+            failed.append(module)
+
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    totals = [m['total_ms'] for m in report.values() if 'total_ms' in m]
+    if len(totals) > 0:
+        print('median import time {:.0f} ms over {} modules'.format(np.median(totals), len(totals)), file=sys.stderr)
+    if failed:
+        sys.exit('over budget, failing or importing forbidden packages: {}'.format(', '.join(sorted(set(failed)))))
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import argparse
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from model.vtoonify import VToonify
+from model.bisenet.model import BiSeNet
+from model.encoder.encoders.psp_encoders import GradualStyleEncoder
+from style_registry import StyleRegistry
+from util import add_latent_avg_hook
+
+# file layout: MAGIC | uint64 header length | json header | tensor data, every tensor 64 byte aligned.
+# the header maps each tensor name to its dtype, shape and offset from the start of the data
+MAGIC = b'VTBUNDL1'
+ALIGNMENT = 64
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Pack the Inference Models into one Bundle")
+        self.parser.add_argument("--ckpt", type=str, default='./checkpoint/vtoonify_d_cartoon/vtoonify_s299_d0.5.pt', help="path of the vtoonify checkpoint")
+        self.parser.add_argument("--faceparsing_path", type=str, default='./checkpoint/faceparsing.pth', help="path of the face parsing model")
+        self.parser.add_argument("--style_encoder_path", type=str, default='./checkpoint/encoder.pt', help="path of the style encoder")
+        self.parser.add_argument("--exstyle_path", type=str, default=None, help="path of the extrinsic style code, next to the checkpoint by default")
+        self.parser.add_argument("--output", type=str, default=None, help="path of the bundle, the checkpoint name with .bundle by default")
+        self.parser.add_argument("--prune", action="store_true", help="leave out the vtoonify layers inference never runs, see prune_vtoonify.py")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        if self.opt.exstyle_path is None:
+            self.opt.exstyle_path = os.path.join(os.path.dirname(self.opt.ckpt), 'exstyle_code.npy')
+        if self.opt.output is None:
+            self.opt.output = os.path.splitext(self.opt.ckpt)[0] + '.bundle'
+        return self.opt
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_bundle(path: str, tensors: Dict[str, torch.Tensor], meta: Dict):
+    arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in tensors.items()}
+    index = {}
+    offset = 0
+    for name, array in arrays.items():
+        index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'tensors': index, 'meta': meta}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    # written next to the target and renamed, a reader never sees half a bundle
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + index[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def open_bundle(path: str) -> Tuple[Dict[str, torch.Tensor], Dict]:
+    # tensors are views into one copy-on-write mapping of the file, nothing is read until it is used
+    # and forked workers share the pages through the page cache
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an inference bundle'.format(path))
+        header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = _aligned(len(MAGIC) + 8 + header_len)
+
+    mapped = np.memmap(path, dtype=np.uint8, mode='c')
+    tensors = {}
+    for name, entry in header['tensors'].items():
+        dtype = np.dtype(entry['dtype'])
+        start = data_start + entry['offset']
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(entry['shape'])
+        tensors[name] = torch.from_numpy(array)
+    return tensors, header['meta']
+
+
+_skip_init_lock = threading.Lock()
+_skip_init_depth = 0
+_skip_init_originals = {}
+_skip_init_local = threading.local()
+
+
+def _unless_skipped(original, replacement):
+    # only the threads inside skip_init get the replacement, the others keep initializing
+    @functools.wraps(original)
+    def patched(*args, **kwargs):
+        if getattr(_skip_init_local, 'depth', 0) > 0:
+            return replacement(*args, **kwargs)
+        return original(*args, **kwargs)
+    return patched
+
+
+@contextmanager
+def skip_init():
+    # the weights are replaced right after construction, so the random initialization of
+    # the ~2GB of parameters is wasted work. only used while the models are built at start-up.
+    # the functions are patched process wide until the last thread leaves, but they only skip
+    # for the threads that are inside skip_init
+    global _skip_init_depth
+    replacements = {
+        (torch, 'randn'): lambda *size, **kwargs: torch.empty(*size, **kwargs),
+        (nn.init, 'kaiming_uniform_'): lambda tensor, *args, **kwargs: tensor,
+        (nn.init, 'kaiming_normal_'): lambda tensor, *args, **kwargs: tensor,
+        (nn.init, 'uniform_'): lambda tensor, *args, **kwargs: tensor,
+        (nn.init, 'normal_'): lambda tensor, *args, **kwargs: tensor,
+    }
+    with _skip_init_lock:
+        if _skip_init_depth == 0:
+            _skip_init_originals.update({key: getattr(*key) for key in replacements})
+            for (owner, name), replacement in replacements.items():
+                setattr(owner, name, _unless_skipped(_skip_init_originals[owner, name], replacement))
+        _skip_init_depth += 1
+    _skip_init_local.depth = getattr(_skip_init_local, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _skip_init_local.depth -= 1
+        with _skip_init_lock:
+            _skip_init_depth -= 1
+            if _skip_init_depth == 0:
+                for (owner, name), original in _skip_init_originals.items():
+                    setattr(owner, name, original)
+                _skip_init_originals.clear()
+
+
+def assign_tensors(module: nn.Module, tensors: Dict[str, torch.Tensor], prefix: str):
+    # like load_state_dict, but the module keeps the given tensors instead of copying them
+    expected = set(module.state_dict().keys())
+    provided = {name[len(prefix):] for name in tensors if name.startswith(prefix)}
+    if expected != provided:
+        raise KeyError('bundle does not match the model under {}: missing {}, unexpected {}'.format(
+            prefix, sorted(expected - provided)[:5], sorted(provided - expected)[:5]))
+    for name in expected:
+        owner_name, _, leaf = name.rpartition('.')
+        owner = functools.reduce(getattr, owner_name.split('.'), module) if owner_name else module
+        tensor = tensors[prefix + name]
+        if leaf in owner._parameters:
+            if owner._parameters[leaf].shape != tensor.shape:
+                raise ValueError('shape of {}{} is {}, the model expects {}'.format(
+                    prefix, name, tuple(tensor.shape), tuple(owner._parameters[leaf].shape)))
+            owner._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            owner._buffers[leaf] = tensor
+
+
+def pack_models(path: str, models: Tuple[VToonify, BiSeNet, GradualStyleEncoder, StyleRegistry]):
+    vtoonify, parsingpredictor, pspencoder, exstyles = models
+    tensors = {}
+    for prefix, module in (('vtoonify.', vtoonify), ('parsing.', parsingpredictor), ('psp.', pspencoder)):
+        for name, tensor in module.state_dict().items():
+            tensors[prefix + name] = tensor
+    tensors['latent_avg'] = pspencoder.latent_avg
+    tensors['exstyles'] = exstyles.codes
+    meta = {
+        'backbone': vtoonify.backbone,
+        'pruned': vtoonify.pruned,
+        'psp_opts': {'input_nc': pspencoder.opts.input_nc, 'n_styles': pspencoder.opts.n_styles},
+        'style_names': exstyles.names,
+    }
+    save_bundle(path, tensors, meta)
+
+
+def load_models(path: str, device: str = 'cuda', style_id: int = 0
+                ) -> Tuple[VToonify, BiSeNet, GradualStyleEncoder, StyleRegistry]:
+    tensors, meta = open_bundle(path)
+    with skip_init():
+        vtoonify = VToonify(backbone=meta['backbone'])
+        parsingpredictor = BiSeNet(n_classes=19, pretrained_backbone=False)
+        pspencoder = GradualStyleEncoder(50, 'ir_se', argparse.Namespace(**meta['psp_opts']))
+    if meta.get('pruned', False):
+        vtoonify.prune_for_inference()
+    assign_tensors(vtoonify, tensors, 'vtoonify.')
+    assign_tensors(parsingpredictor, tensors, 'parsing.')
+    assign_tensors(pspencoder, tensors, 'psp.')
+    for module in (vtoonify, parsingpredictor, pspencoder):
+        # tells WorkerPool the weights already live in a file mapping that forked workers share
+        module.bundle_path = path
+
+    vtoonify.to(device)
+    parsingpredictor.to(device).eval()
+    pspencoder.to(device).eval()
+    pspencoder.opts = argparse.Namespace(**meta['psp_opts'])
+    add_latent_avg_hook(pspencoder, tensors['latent_avg'].to(device))
+    # the W+ codes are stored already mapped, no zplus2wplus at start-up
+    exstyles = StyleRegistry(tensors['exstyles'].to(device), meta['style_names'], style_id)
+    return vtoonify, parsingpredictor, pspencoder, exstyles
+
+
+if __name__ == "__main__":
+    from style_transfer import create_image_style_transfer_dualstylegan_models
+
+    parser = Options()
+    args = parser.parse()
+
+    start = time.time()
+    models = create_image_style_transfer_dualstylegan_models(0, 'cpu', args.ckpt, args.faceparsing_path,
+                                                             args.style_encoder_path, args.exstyle_path)
+    print('loaded checkpoints in {:.2f}s'.format(time.time() - start))
+    if args.prune:
+        models[0].prune_for_inference()
+    pack_models(args.output, models)
+
+    start = time.time()
+    load_models(args.output, 'cpu')
+    print('saved {} ({:.0f} MB), it loads in {:.2f}s'.format(
+        args.output, os.path.getsize(args.output) / 2**20, time.time() - start))
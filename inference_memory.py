@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+import torch
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Peak Memory of VToonify Inference, Normal vs Lean")
+        self.parser.add_argument("--ckpt", type=str, default=None, help="vtoonify checkpoint, random weights by default")
+        self.parser.add_argument("--backbone", type=str, default='dualstylegan', help="dualstylegan | toonify")
+        self.parser.add_argument("--size", type=int, default=256, help="height and width of the input frames")
+        self.parser.add_argument("--batch", type=int, default=4, help="frames per forward")
+        self.parser.add_argument("--runs", type=int, default=3, help="forwards per mode, the median latency is reported")
+        self.parser.add_argument("--cpu", action="store_true", help="run on cpu even if cuda is available")
+        self.parser.add_argument("--output", type=str, default=None, help="also write the json report to this path")
+        # internal, set for the child processes
+        self.parser.add_argument("--mode", type=str, default=None, help=argparse.SUPPRESS)
+        self.parser.add_argument("--result", type=str, default=None, help=argparse.SUPPRESS)
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(args):
+    # one mode in this process: the peak memory added by the forwards on top of the loaded model
+    from model.vtoonify import VToonify
+    from delta_checkpoint import load_vtoonify
+
+    device = 'cpu' if args.cpu or not torch.cuda.is_available() else 'cuda'
+    torch.manual_seed(0)
+    vtoonify = VToonify(backbone=args.backbone)
+    if args.ckpt is not None:
+        load_vtoonify(vtoonify, args.ckpt)
+    vtoonify.to(device).eval()
+    vtoonify.lean_inference(args.mode == 'lean')
+
+    # one style for the whole batch, like the frames of a video
+    x = torch.randn(args.batch, 22, args.size, args.size, device=device)
+    style = torch.randn(1, vtoonify.generator.n_latent, vtoonify.style_channels, device=device).repeat(args.batch, 1, 1)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = peak_rss_bytes()
+
+    times = []
+    with torch.no_grad():
+        for _ in range(args.runs):
+            start = time.time()
+            y = vtoonify(x, style, d_s=0.5)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - start)
+    peak = (torch.cuda.max_memory_allocated() if device == 'cuda' else peak_rss_bytes()) - base
+
+    torch.save(y.cpu(), args.result)
+    return {'device': device, 'peak_mb': peak / 2**20, 'latency_ms': sorted(times)[len(times) // 2] * 1000}
+
+def run_mode(mode, argv):
+    # a fresh interpreter per mode, the peak rss of a process never goes down
+    result = tempfile.NamedTemporaryFile(suffix='.pt', delete=False)
+    result.close()
+    process = subprocess.run([sys.executable, os.path.abspath(__file__)] + argv + ['--mode', mode, '--result', result.name],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError('{} inference failed'.format(mode))
+    report = json.loads(process.stdout.strip().splitlines()[-1])
+    output = torch.load(result.name)
+    os.remove(result.name)
+    return report, output
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    if args.mode is not None:
+        print(json.dumps(measure(args)))
+        sys.exit()
+
+    report = {}
+    outputs = {}
+    for mode in ['normal', 'lean']:
+        report[mode], outputs[mode] = run_mode(mode, sys.argv[1:])
+    report['max_diff'] = (outputs['normal'] - outputs['lean']).abs().max().item()
+    report['peak_saved_mb'] = report['normal']['peak_mb'] - report['lean']['peak_mb']
+
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,219 @@
+import os
+import sys
+import glob
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import uuid
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Load Test for the Style Transfer Server")
+        self.parser.add_argument("--url", type=str, default='http://127.0.0.1:8001', help="base url of the server")
+        self.parser.add_argument("--endpoint", type=str, default='/changeBg', help="endpoint the images are posted to")
+        self.parser.add_argument("--images", type=str, default='./data/*.jpg', help="glob of the image corpus to replay")
+        self.parser.add_argument("--concurrency", type=int, default=4, help="number of requests in flight at most")
+        self.parser.add_argument("--rate", type=float, default=0, help="poisson arrival rate in requests/s, 0 sends back-to-back (closed loop)")
+        self.parser.add_argument("--requests", type=int, default=100, help="number of requests to send")
+        self.parser.add_argument("--timeout", type=float, default=120, help="timeout of a single request in seconds")
+        self.parser.add_argument("--accept", type=str, default='application/json', help="Accept header, e.g. image/jpeg for binary responses")
+        self.parser.add_argument("--start_server", action="store_true", help="start server.py in a subprocess and wait for /readyz")
+        self.parser.add_argument("--server_pid", type=int, default=None, help="pid of an already running server, to sample its memory")
+        self.parser.add_argument("--seed", type=int, default=0, help="seed of the arrival times and image order")
+        self.parser.add_argument("--output", type=str, default=None, help="also write the json report to this path")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+def encode_multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        '--{}\r\n'.format(boundary).encode(),
+        'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'.format(field, filename).encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        data,
+        '\r\n--{}--\r\n'.format(boundary).encode(),
+    ])
+    return body, 'multipart/form-data; boundary={}'.format(boundary)
+
+def send(url, filename, data, accept, timeout):
+    # returns (status, latency in seconds), status is None when the request did not complete
+    body, content_type = encode_multipart('image', filename, data)
+    req = urllib.request.Request(url, data=body, method='POST',
+                                 headers={'Content-Type': content_type, 'Accept': accept})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return status, time.perf_counter() - start
+
+def process_tree(pid):
+    pids = [pid]
+    for p in pids:
+        for task in glob.glob('/proc/{}/task/*/children'.format(p)):
+            try:
+                with open(task) as f:
+                    pids += [int(c) for c in f.read().split()]
+            except OSError:
+                pass
+    return pids
+
+def read_status_kb(pid, field, name='status'):
+    try:
+        with open('/proc/{}/{}'.format(pid, name)) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class MemorySampler():
+    '''
+    Samples the resident memory of the server and its forked workers while the test runs.
+
+    The Pss sum counts every page shared between the processes (the model weights mapped by all
+    workers) once, split among them, so it is the real footprint. The VmRSS sum counts shared
+    pages once per process and overstates it with several workers.
+    '''
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self.peak_pss_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            pids = process_tree(self.pid)
+            rss = sum(read_status_kb(p, 'VmRSS') for p in pids)
+            # smaps_rollup needs linux 4.14
+            pss = sum(read_status_kb(p, 'Pss', 'smaps_rollup') for p in pids)
+            self.peak_rss_kb = max(self.peak_rss_kb, rss)
+            self.peak_pss_kb = max(self.peak_pss_kb, pss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def wait_ready(url, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/readyz', timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(1)
+    return False
+
+def run(args, corpus):
+    rng = random.Random(args.seed)
+    url = args.url + args.endpoint
+    order = [rng.randrange(len(corpus)) for _ in range(args.requests)]
+    results = [None] * args.requests
+
+    def task(i, scheduled):
+        filename, data = corpus[order[i]]
+        status, latency = send(url, filename, data, args.accept, args.timeout)
+        if args.rate > 0:
+            # count the time spent waiting for a free connection as well, to avoid coordinated omission
+            latency = time.perf_counter() - scheduled
+        results[i] = (status, latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(args.requests):
+            if args.rate > 0:
+                # open loop, requests arrive as a poisson process whether or not earlier ones are done
+                time.sleep(rng.expovariate(args.rate))
+            executor.submit(task, i, time.perf_counter())
+    elapsed = time.perf_counter() - start
+    return results, elapsed
+
+def summarize(args, results, elapsed):
+    latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {
+        'requests': len(results),
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+        'elapsed_s': elapsed,
+        'throughput_rps': len(latencies) / elapsed,
+        'error_rate': 1 - len(latencies) / len(results),
+        'status_counts': statuses,
+    }
+    if len(latencies) > 0:
+        report['latency_ms'] = {
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'max': float(latencies.max()),
+        }
+    return report
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    corpus = []
+    for filename in sorted(glob.glob(args.images)):
+        with open(filename, 'rb') as f:
+            corpus.append((os.path.basename(filename), f.read()))
+    if len(corpus) == 0:
+        sys.exit('no images match {}'.format(args.images))
+
+    server = None
+    pid = args.server_pid
+    if args.start_server:
+        server = subprocess.Popen([sys.executable, 'server.py'], cwd=os.path.dirname(os.path.abspath(__file__)))
+        pid = server.pid
+        if not wait_ready(args.url):
+            server.terminate()
+            sys.exit('server did not become ready')
+
+    try:
+        if pid is not None:
+            with MemorySampler(pid) as sampler:
+                results, elapsed = run(args, corpus)
+            report = summarize(args, results, elapsed)
+            report['peak_pss_mb'] = sampler.peak_pss_kb / 1024
+            report['peak_rss_sum_mb'] = sampler.peak_rss_kb / 1024
+            report['server_vm_hwm_mb'] = read_status_kb(pid, 'VmHWM') / 1024
+        else:
+            results, elapsed = run(args, corpus)
+            report = summarize(args, results, elapsed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
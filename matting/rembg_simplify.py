@@ -1,11 +1,9 @@
 import os
 import io
 import numpy as np
-import onnxruntime as ort
-import pooch
 from pathlib import Path
 from enum import Enum
-from typing import List, Union, Dict, Tuple, Type
+from typing import TYPE_CHECKING, List, Union, Dict, Tuple, Type
 from cv2 import (
     BORDER_DEFAULT,
     COLOR_BGR2GRAY,
@@ -20,8 +18,15 @@ from cv2 import (
 )
 from PIL import Image
 from PIL.Image import Image as PILImage
+from resource_pool import ResourcePool
+
+# onnxruntime and pooch are only needed once a session is built
+if TYPE_CHECKING:
+    import onnxruntime as ort
 
 kernel = getStructuringElement(MORPH_ELLIPSE, (3, 3))
+# a resolved local .onnx file, set by the server when it uses a model store
+default_model_path: Union[str, None] = None
 
 
 class ReturnType(Enum):
@@ -31,7 +36,7 @@ class ReturnType(Enum):
 
 
 class SimpleSession:
-    def __init__(self, model_name: str, inner_session: ort.InferenceSession):
+    def __init__(self, model_name: str, inner_session: "ort.InferenceSession"):
         self.model_name = model_name
         self.inner_session = inner_session
 
@@ -82,7 +87,10 @@ class SimpleSession:
         return [mask]
 
 
-def new_session(model_name: str = "u2net") -> SimpleSession:
+def model_file(model_name: str = "u2net", model_path: Union[str, None] = None) -> Tuple[Path, Type[SimpleSession]]:
+    # model_path (or default_model_path, or the U2NET_PATH env var) points at a local .onnx
+    # file, nothing is downloaded then. otherwise the model is looked up in U2NET_HOME and only
+    # fetched when it is missing there, unless U2NET_OFFLINE=1
     session_class: Type[SimpleSession]
     md5 = "60024c5c889badc19c04ad937298a77b"
     url = "https://github.com/danielgatis/rembg/releases/download/v0.0.0/u2net.onnx"
@@ -115,15 +123,31 @@ def new_session(model_name: str = "u2net") -> SimpleSession:
 
     fname = "u2net.onnx"
     full_path = Path(u2net_home).expanduser() / fname
+    if model_path is None:
+        model_path = default_model_path or os.getenv("U2NET_PATH")
+
+    if model_path is not None:
+        full_path = Path(model_path).expanduser()
+        if not full_path.is_file():
+            raise FileNotFoundError("u2net model not found at {}".format(full_path))
+    elif not full_path.is_file():
+        if os.getenv("U2NET_OFFLINE") == "1":
+            raise FileNotFoundError("u2net model not found at {} and downloads are off".format(full_path))
+        import pooch
+        # Download and cache a single file locally.
+        pooch.retrieve(
+            url,
+            f"md5:{md5}",
+            fname=fname,
+            path=Path(u2net_home).expanduser(),
+            progressbar=True,
+        )
+    return full_path, session_class
 
-    # Download and cache a single file locally.
-    pooch.retrieve(
-        url,
-        f"md5:{md5}",
-        fname=fname,
-        path=Path(u2net_home).expanduser(),
-        progressbar=True,
-    )
+
+def new_session(model_name: str = "u2net", model_path: Union[str, None] = None) -> SimpleSession:
+    import onnxruntime as ort
+    full_path, session_class = model_file(model_name, model_path)
 
     sess_opts = ort.SessionOptions()
 
@@ -139,7 +163,8 @@ def new_session(model_name: str = "u2net") -> SimpleSession:
         ),
     )
 
-session = new_session()
+# an onnxruntime session per concurrent caller, the server raises the size from its config
+sessions = ResourcePool(new_session, int(os.getenv("U2NET_SESSIONS", "1")), "u2net")
 
 def naive_cutout(img: PILImage, mask: PILImage) -> PILImage:
     empty = Image.new("RGBA", (img.size), 0)
@@ -191,7 +216,8 @@ def remove(
     else:
         raise ValueError("Input type {} is not supported.".format(type(data)))
 
-    masks = session.predict(img)
+    with sessions.checkout() as session:
+        masks = session.predict(img)
     cutouts = []
 
     for mask in masks:
@@ -0,0 +1,94 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+# upper bounds in seconds, a stage of the pipeline takes anything from a millisecond to a few seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+
+class Histogram():
+    '''
+    Prometheus style histogram with one label, e.g. vtoonify_stage_seconds{stage="psp"}.
+    '''
+    def __init__(self, name: str, help: str, label: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self._sums = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            self._counts[label_value][bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[label_value] += value
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_value in sorted(self._counts):
+                counts = self._counts[label_value]
+                label = '{}="{}"'.format(self.label, label_value)
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, le, total))
+                lines.append('{}_sum{{{}}} {}'.format(self.name, label, self._sums[label_value]))
+                lines.append('{}_count{{{}}} {}'.format(self.name, label, total))
+        return lines
+
+
+STAGE_SECONDS = Histogram('vtoonify_stage_seconds', 'Latency of every stage of the stylization pipeline.', 'stage')
+QUEUE_WAIT_SECONDS = Histogram('vtoonify_queue_wait_seconds', 'Time a request waited for admission.', 'outcome')
+HISTOGRAMS = [STAGE_SECONDS, QUEUE_WAIT_SECONDS]
+
+_local = threading.local()
+
+
+@contextmanager
+def collect():
+    # gathers the (stage, seconds) pairs timed on this thread, e.g. for a Server-Timing header
+    previous = getattr(_local, 'timings', None)
+    _local.timings = []
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def stage_timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timings([(stage, time.perf_counter() - start)])
+
+
+def record_timings(timings: List[Tuple[str, float]], observe: bool = True):
+    # observe=False when the stages were already observed on another thread of this process
+    # and only have to be attributed to the request running here
+    for stage, seconds in timings:
+        if observe:
+            STAGE_SECONDS.observe(stage, seconds)
+        if getattr(_local, 'timings', None) is not None:
+            _local.timings.append((stage, seconds))
+
+
+def server_timing(timings: List[Tuple[str, float]]) -> str:
+    totals: Dict[str, float] = defaultdict(float)
+    for stage, seconds in timings:
+        totals[stage] += seconds
+    return ', '.join('{};dur={:.1f}'.format(stage, seconds * 1000) for stage, seconds in totals.items())
+
+
+def render() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines += histogram.render()
+    return '\n'.join(lines) + '\n'
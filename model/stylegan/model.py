@@ -224,9 +224,43 @@ class ModulatedConv2d(nn.Module):
             f"upsample={self.upsample}, downsample={self.downsample})"
         )
 
-    def forward(self, input, style, externalweight=None):
+    def modulated_weight(self, style, externalweight=None):
+        # the kernel of each style, (n_styles, out_channel, in_channel, kernel_size, kernel_size)
+        n_styles = style.size(0)
+        style = self.modulation(style).view(n_styles, 1, self.in_channel, 1, 1)
+        if externalweight is None:
+            weight = self.scale * self.weight * style
+        else:
+            weight = self.scale * (self.weight + externalweight) * style
+
+        if self.demodulate:
+            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
+            weight = weight * demod.view(n_styles, self.out_channel, 1, 1, 1)
+        return weight
+
+    def shared_conv(self, input, weight):
+        # one dense convolution of the whole batch with a single (out_channel, in_channel, k, k) kernel
+        if self.upsample:
+            out = conv2d_gradfix.conv_transpose2d(
+                input, weight.transpose(0, 1), padding=0, stride=2
+            )
+            return self.blur(out)
+
+        if self.downsample:
+            input = self.blur(input)
+            return conv2d_gradfix.conv2d(input, weight, padding=0, stride=2)
+
+        return conv2d_gradfix.conv2d(input, weight, padding=self.padding)
+
+    def forward(self, input, style, externalweight=None, shared_style=False):
         batch, in_channel, height, width = input.shape
 
+        # the whole batch has one style: a single style row, or the caller says so.
+        # the kernel is modulated once and the batch goes through one ordinary convolution
+        # instead of a grouped one with a kernel per sample
+        if shared_style or style.size(0) == 1:
+            return self.shared_conv(input, self.modulated_weight(style[:1], externalweight)[0])
+
         if not self.fused:
             weight = self.scale * self.weight.squeeze(0)
             style = self.modulation(style)
@@ -256,16 +290,7 @@ class ModulatedConv2d(nn.Module):
 
             return out
 
-        style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
-        if externalweight is None:
-            weight = self.scale * self.weight * style
-        else:
-            weight = self.scale * (self.weight + externalweight) * style
-
-        if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
-            weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
-
+        weight = self.modulated_weight(style, externalweight)
         weight = weight.view(
             batch * self.out_channel, in_channel, self.kernel_size, self.kernel_size
         )
@@ -361,8 +386,8 @@ class StyledConv(nn.Module):
         # self.activate = ScaledLeakyReLU(0.2)
         self.activate = FusedLeakyReLU(out_channel)
 
-    def forward(self, input, style, noise=None, externalweight=None):
-        out = self.conv(input, style, externalweight)
+    def forward(self, input, style, noise=None, externalweight=None, shared_style=False):
+        out = self.conv(input, style, externalweight, shared_style)
         out = self.noise(out, noise=noise)
         # out = out + self.bias
         out = self.activate(out)
@@ -380,8 +405,8 @@ class ToRGB(nn.Module):
         self.conv = ModulatedConv2d(in_channel, 3, 1, style_dim, demodulate=False)
         self.bias = nn.Parameter(torch.zeros(1, 3, 1, 1))
 
-    def forward(self, input, style, skip=None, externalweight=None):
-        out = self.conv(input, style, externalweight)
+    def forward(self, input, style, skip=None, externalweight=None, shared_style=False):
+        out = self.conv(input, style, externalweight, shared_style)
         out = out + self.bias
 
         if skip is not None:
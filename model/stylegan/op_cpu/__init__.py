@@ -1,2 +1,2 @@
-from .fused_act import FusedLeakyReLU, fused_leaky_relu
+from .fused_act import FusedLeakyReLU, fused_leaky_relu, fused_leaky_relu_
 from .upfirdn2d import upfirdn2d
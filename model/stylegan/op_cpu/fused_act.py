@@ -31,4 +31,12 @@ def fused_leaky_relu(inputs, bias=None, negative_slope=0.2, scale=2 ** 0.5):
         )
 
     else:
-        return F.leaky_relu(inputs, negative_slope=negative_slope) * scale
\ No newline at end of file
+        return F.leaky_relu(inputs, negative_slope=negative_slope) * scale
+
+
+def fused_leaky_relu_(inputs, bias=None, negative_slope=0.2, scale=2 ** 0.5):
+    # in place version for inference, inputs must not be needed afterwards
+    if bias is not None:
+        rest_dim = [1] * (inputs.ndim - bias.ndim - 1)
+        inputs.add_(bias.view(1, bias.shape[0], *rest_dim))
+    return F.leaky_relu_(inputs, negative_slope=negative_slope).mul_(scale)
\ No newline at end of file
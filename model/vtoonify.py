@@ -3,8 +3,11 @@ import numpy as np
 import math
 from torch import nn
 from model.stylegan.model import ConvLayer, EqualLinear, Generator, ResBlock
+from model.stylegan.op_cpu import fused_leaky_relu_
 from model.dualstylegan import AdaptiveInstanceNorm, AdaResBlock, DualStyleGAN
 import torch.nn.functional as F
+import threading
+from collections import OrderedDict
 
 # IC-GAN: stylegan discriminator    
 class ConditionalDiscriminator(nn.Module):
@@ -206,8 +209,20 @@ class VToonify(nn.Module):
                 self.res.append(AdaResBlock(out_channel, dilation=2**(5-i)))
                 self.res.append(AdaResBlock(out_channel, dilation=2**(5-i)))
 
+        # see lean_inference
+        self.lean = False
+        self.arena = None
+        # see prune_for_inference
+        self.pruned = False
+
     
     def forward(self, x, style, d_s=None, return_mask=False, return_feat=False):
+        # the frames of a video usually repeat one style (s_w.repeat(batch, 1, 1)), then one style row
+        # is mapped and every generator layer runs a single convolution with one kernel for the batch
+        if style is not None and style.size(0) > 1 and torch.equal(style, style[:1].expand_as(style)):
+            style = style[:1]
+        if self.lean and not torch.is_grad_enabled():
+            return self.forward_lean(x, style, d_s, return_mask, return_feat)
         # map style to W+ space
         if style is not None and style.ndim < 3:
             if self.backbone == 'dualstylegan':
@@ -276,6 +291,121 @@ class VToonify(nn.Module):
             return image, m_Es
         return image
     
+    def lean_inference(self, enabled=True):
+        # switches forward to forward_lean whenever gradients are off, returns self like eval()
+        self.lean = enabled
+        if enabled and self.arena is None:
+            self.arena = BufferArena()
+        return self
+
+    def release_buffers(self):
+        # the forward_lean buffers of the calling thread, for threads that serve unrelated requests
+        if self.arena is not None:
+            self.arena.clear()
+
+    def forward_lean(self, x, style, d_s=None, return_mask=False, return_feat=False):
+        # the same result as forward with far fewer temporaries, for inference only: the zero noise
+        # is never made, the styles are not cloned, bias and leaky relu of the generator layers are
+        # applied in place, and the fusion inputs are written into buffers reused between calls
+        n_latent = self.generator.n_latent
+        if style.ndim < 3:
+            if self.backbone == 'dualstylegan':
+                resstyles = self.generator.style(style).unsqueeze(1).repeat(1, n_latent, 1)
+            adastyles = [style] * n_latent
+        else:
+            nB, nL, nD = style.shape
+            if self.backbone == 'dualstylegan':
+                resstyles = self.generator.style(style.reshape(nB*nL, nD)).reshape(nB, nL, nD)
+            adastyles = [style[:, i] for i in range(nL)]
+        if self.backbone == 'dualstylegan':
+            adastyles = [self.generator.res[i](adastyle) if i >= 7 else adastyle for i, adastyle in enumerate(adastyles)]
+
+        feat = x
+        encoder_features = []
+        for block in self.encoder[:-2]:
+            feat = block(feat)
+            encoder_features.append(feat)
+        encoder_features = encoder_features[::-1]
+        for ii, block in enumerate(self.encoder[-2]):
+            feat = block(feat)
+            if self.backbone == 'dualstylegan':
+                feat = self.res[ii+1](feat, resstyles[:, ii+1], d_s)
+        out = feat
+        skip = self.encoder[-1](feat)
+        if return_feat:
+            return out, skip
+
+        buffers = self.arena.plan((tuple(x.shape), x.dtype, x.device))
+        _index = 1
+        m_Es = []
+        for conv1, conv2, to_rgb in zip(
+            self.stylegan().convs[6::2], self.stylegan().convs[7::2], self.stylegan().to_rgbs[3:]):
+
+            if 2 ** (5+((_index-1)//2)) <= self.in_size:
+                fusion_index = (_index - 1) // 2
+                f_E = encoder_features[fusion_index]
+                B, C, H, W = f_E.shape
+                # [out, f_E-ish] and [skip, f_E-ish] live in two buffers per fusion layer
+                fused = self.arena.buffer(buffers, 'fused%d' % fusion_index, (B, out.size(1) + C, H, W), f_E)
+                skipped = self.arena.buffer(buffers, 'skip%d' % fusion_index, (B, skip.size(1) + C, H, W), f_E)
+                fused[:, :out.size(1)].copy_(out)
+                skipped[:, :skip.size(1)].copy_(skip)
+                if self.backbone == 'dualstylegan':
+                    fusion = self.fusion_out[fusion_index]
+                    label = fusion.linear(torch.zeros(B, 1, device=f_E.device) + d_s)
+                    torch.sub(out, f_E, out=fused[:, out.size(1):]).abs_()
+                    m_E = fusion.conv2(self._adain_(fusion.norm, fused, label)).relu_().tanh_()
+                    torch.mul(f_E, m_E, out=skipped[:, skip.size(1):])
+                    fused[:, out.size(1):].copy_(skipped[:, skip.size(1):])
+                    out = fusion.conv(fused)
+                    skip = self.fusion_skip[fusion_index](skipped)
+                    m_Es += [m_E]
+                else:
+                    fused[:, out.size(1):].copy_(f_E)
+                    skipped[:, skip.size(1):].copy_(f_E)
+                    out = self.fusion_out[fusion_index](fused)
+                    skip = self.fusion_skip[fusion_index](skipped)
+
+            for conv, adastyle in ((conv1, adastyles[_index+6]), (conv2, adastyles[_index+7])):
+                out = conv.conv(out, adastyle)
+                out = fused_leaky_relu_(out, conv.activate.bias, conv.activate.negative_slope, conv.activate.scale)
+            rgb = to_rgb.conv(out, adastyles[_index+8])
+            skip = rgb.add_(to_rgb.bias).add_(to_rgb.upsample(skip))
+            _index += 2
+
+        image = skip
+        if return_mask and self.backbone == 'dualstylegan':
+            return image, m_Es
+        return image
+
+    @staticmethod
+    def _adain_(norm, input, style):
+        # AdaptiveInstanceNorm.forward without the gamma * out + beta temporaries
+        gamma, beta = norm.style(style).unsqueeze(2).unsqueeze(3).chunk(2, 1)
+        return norm.norm(input).mul_(gamma).add_(beta)
+
+    def pruned_modules(self):
+        # (parent, name, state dict prefix) of every submodule forward never reaches: the constant
+        # input, the 4x4 to 16x16 layers of the generator that the encoder features replace, its
+        # noise buffers, and the ModRes blocks of DualStyleGAN whose copies live in self.res
+        stylegan = self.stylegan()
+        prefix = 'generator.generator.' if self.backbone == 'dualstylegan' else 'generator.'
+        modules = [(stylegan, name, prefix + name) for name in ('input', 'conv1', 'to_rgb1', 'noises')]
+        modules += [(stylegan.convs, str(i), prefix + 'convs.%d' % i) for i in range(6)]
+        modules += [(stylegan.to_rgbs, str(i), prefix + 'to_rgbs.%d' % i) for i in range(3)]
+        if self.backbone == 'dualstylegan':
+            modules += [(self.generator.res, str(i), 'generator.res.%d' % i) for i in range(7)]
+            modules += [(self.res, '0', 'res.0')]
+        return modules
+
+    def prune_for_inference(self):
+        # drops the pruned_modules in place, for a smaller model and checkpoint that can only run
+        # forward and zplus2wplus. the placeholders keep the indices of the module lists
+        for parent, name, _ in self.pruned_modules():
+            setattr(parent, name, PrunedLayer())
+        self.pruned = True
+        return self
+
     def stylegan(self):
         if self.backbone == 'dualstylegan':
             return self.generator.generator
@@ -283,4 +413,218 @@ class VToonify(nn.Module):
             return self.generator
         
     def zplus2wplus(self, zplus):
-        return self.stylegan().style(zplus.reshape(zplus.shape[0]*zplus.shape[1], zplus.shape[2])).reshape(zplus.shape)
\ No newline at end of file
+        return self.stylegan().style(zplus.reshape(zplus.shape[0]*zplus.shape[1], zplus.shape[2])).reshape(zplus.shape)
+    
+    def compile_for_style(self, style, d_s=1):
+        # a copy of the forward pass for one fixed style (1x512 or 1x18x512) and style degree,
+        # e.g. a whole video sharing one s_w. see BakedVToonify
+        return BakedVToonify(self, style, d_s)
+
+
+class PrunedLayer(nn.Module):
+    # stands in for a layer prune_for_inference removed
+    def forward(self, *args, **kwargs):
+        raise RuntimeError('this layer was pruned for inference')
+
+class BufferArena():
+    '''
+    Scratch tensors of forward_lean, per thread and per input shape. A plan holds the buffers
+    one input shape needs, only the most recently used `max_plans` of them are kept.
+
+    The plans of a thread live as long as the thread unless it calls clear, e.g. every thread of
+    an executor keeps up to `max_plans` sets of full resolution buffers. A copy or a pickle of the
+    arena starts without any.
+    '''
+    def __init__(self, max_plans=2):
+        self.max_plans = max_plans
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'max_plans': self.max_plans}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def plan(self, key):
+        plans = getattr(self._local, 'plans', None)
+        if plans is None:
+            plans = self._local.plans = OrderedDict()
+        if key in plans:
+            plans.move_to_end(key)
+        else:
+            plans[key] = {}
+            while len(plans) > self.max_plans:
+                plans.popitem(last=False)
+        return plans[key]
+
+    @staticmethod
+    def buffer(plan, name, shape, like):
+        buffer = plan.get(name)
+        if buffer is None or tuple(buffer.shape) != tuple(shape):
+            buffer = plan[name] = like.new_empty(shape)
+        return buffer
+
+    def clear(self):
+        # frees the plans of the calling thread
+        self._local.plans = OrderedDict()
+
+# layers with their style folded in, they only run plain convolutions on any batch size
+class BakedModulatedConv2d(nn.Module):
+    def __init__(self, conv, style):
+        super().__init__()
+
+        self.conv = conv
+        # the same kernel ModulatedConv2d builds for a batch that shares the style
+        self.register_buffer('weight', conv.modulated_weight(style)[0].contiguous())
+
+    def forward(self, input):
+        return self.conv.shared_conv(input, self.weight)
+
+class BakedStyledConv(nn.Module):
+    def __init__(self, styled_conv, style):
+        super().__init__()
+
+        self.conv = BakedModulatedConv2d(styled_conv.conv, style)
+        # VToonify feeds zero noise, so the noise injection is left out
+        self.activate = styled_conv.activate
+
+    def forward(self, input):
+        return self.activate(self.conv(input))
+
+class BakedToRGB(nn.Module):
+    def __init__(self, to_rgb, style):
+        super().__init__()
+
+        self.conv = BakedModulatedConv2d(to_rgb.conv, style)
+        self.bias = to_rgb.bias
+        self.upsample = to_rgb.upsample
+
+    def forward(self, input, skip):
+        return self.conv(input) + self.bias + self.upsample(skip)
+
+class BakedAdaptiveInstanceNorm(nn.Module):
+    def __init__(self, norm, style):
+        super().__init__()
+
+        gamma, beta = norm.style(style).unsqueeze(2).unsqueeze(3).chunk(2, 1)
+        self.register_buffer('gamma', gamma.contiguous())
+        self.register_buffer('beta', beta.contiguous())
+
+    def forward(self, input):
+        return self.gamma * F.instance_norm(input) + self.beta
+
+class BakedAdaResBlock(nn.Module):
+    def __init__(self, block, style, w=1):
+        super().__init__()
+
+        self.conv = block.conv
+        self.conv2 = block.conv2
+        self.norm = BakedAdaptiveInstanceNorm(block.norm, style)
+        self.norm2 = BakedAdaptiveInstanceNorm(block.norm2, style)
+        self.w = w
+
+    def forward(self, x):
+        if self.w == 0:
+            return x
+        out = self.conv(self.norm(x))
+        out = self.conv2(self.norm2(out))
+        return out * self.w + x
+
+class BakedFusion(nn.Module):
+    def __init__(self, fusion, d_s=1):
+        super().__init__()
+
+        self.conv = fusion.conv
+        self.conv2 = fusion.conv2
+        label = fusion.linear(torch.zeros(1, 1, device=fusion.conv.weight.device) + d_s)
+        self.norm = BakedAdaptiveInstanceNorm(fusion.norm, label)
+
+    def forward(self, f_G, f_E):
+        out = torch.cat([f_G, abs(f_G-f_E)], dim=1)
+        m_E = (F.relu(self.conv2(self.norm(out)))).tanh()
+        f_out = self.conv(torch.cat([f_G, f_E * m_E], dim=1))
+        return f_out, m_E
+
+class BakedVToonify(nn.Module):
+    '''
+    VToonify compiled for one style code and style degree.
+
+    The W+ mapping of the style, the ModRes and fusion AdaIN parameters and the modulated and
+    demodulated kernels of the generator layers are computed once, so a call only runs the
+    encoder and plain convolutions. Everything that does not depend on the style is shared with
+    the VToonify it was made from. Give the same `style` and `d_s` to VToonify for the same output.
+    '''
+    def __init__(self, vtoonify, style, d_s=1):
+        super().__init__()
+
+        if style.size(0) != 1:
+            raise ValueError('compile_for_style takes one style, got a batch of {}'.format(style.size(0)))
+        self.backbone = vtoonify.backbone
+        self.in_size = vtoonify.in_size
+        self.encoder = vtoonify.encoder
+        self.fusion_skip = vtoonify.fusion_skip
+        generator = vtoonify.generator
+
+        with torch.no_grad():
+            # the same mapping as the start of VToonify.forward
+            if style.ndim < 3:
+                if self.backbone == 'dualstylegan':
+                    resstyles = generator.style(style).unsqueeze(1).repeat(1, generator.n_latent, 1)
+                adastyles = style.unsqueeze(1).repeat(1, generator.n_latent, 1)
+            else:
+                if self.backbone == 'dualstylegan':
+                    resstyles = generator.style(style[0]).unsqueeze(0)
+                adastyles = style
+            if self.backbone == 'dualstylegan':
+                adastyles = adastyles.clone()
+                for i in range(7, generator.n_latent):
+                    adastyles[:, i] = generator.res[i](adastyles[:, i])
+
+                self.res = nn.ModuleList([BakedAdaResBlock(block, resstyles[:, i], d_s) if not isinstance(block, PrunedLayer) else block
+                                          for i, block in enumerate(vtoonify.res)])
+                self.fusion_out = nn.ModuleList([BakedFusion(fusion, d_s) for fusion in vtoonify.fusion_out])
+            else:
+                self.fusion_out = vtoonify.fusion_out
+
+            stylegan = vtoonify.stylegan()
+            self.convs = nn.ModuleList()
+            self.to_rgbs = nn.ModuleList()
+            for i, to_rgb in enumerate(stylegan.to_rgbs[3:]):
+                _index = 2 * i + 1
+                self.convs.append(BakedStyledConv(stylegan.convs[6 + 2 * i], adastyles[:, _index+6]))
+                self.convs.append(BakedStyledConv(stylegan.convs[7 + 2 * i], adastyles[:, _index+7]))
+                self.to_rgbs.append(BakedToRGB(to_rgb, adastyles[:, _index+8]))
+
+    def forward(self, x, return_mask=False):
+        feat = x
+        encoder_features = []
+        for block in self.encoder[:-2]:
+            feat = block(feat)
+            encoder_features.append(feat)
+        encoder_features = encoder_features[::-1]
+        for ii, block in enumerate(self.encoder[-2]):
+            feat = block(feat)
+            if self.backbone == 'dualstylegan':
+                feat = self.res[ii+1](feat)
+        out = feat
+        skip = self.encoder[-1](feat)
+
+        m_Es = []
+        for i, to_rgb in enumerate(self.to_rgbs):
+            # the first layers get the matching encoder features, the same as VToonify.forward
+            if 2 ** (5 + i) <= self.in_size:
+                f_E = encoder_features[i]
+                if self.backbone == 'dualstylegan':
+                    out, m_E = self.fusion_out[i](out, f_E)
+                    skip = self.fusion_skip[i](torch.cat([skip, f_E*m_E], dim=1))
+                    m_Es += [m_E]
+                else:
+                    out = self.fusion_out[i](torch.cat([out, f_E], dim=1))
+                    skip = self.fusion_skip[i](torch.cat([skip, f_E], dim=1))
+            out = self.convs[2 * i](out)
+            out = self.convs[2 * i + 1](out)
+            skip = to_rgb(out, skip)
+
+        if return_mask and self.backbone == 'dualstylegan':
+            return skip, m_Es
+        return skip
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+# manifest.json in the root of the store: {name: {"sha256": hex digest, "size": bytes}}, where a
+# name is the path relative to the root, e.g. "vtoonify_d_cartoon/vtoonify_s299_d0.5.pt"
+MANIFEST = 'manifest.json'
+# {name: {"sha256", "size", "mtime_ns"}} of the files that were hashed and matched, so that a
+# restart only hashes the files that changed since
+VERIFIED = '.verified.json'
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Write or Check the Checksum Manifest of a Model Directory")
+        self.parser.add_argument("--root", type=str, default='./checkpoint', help="the model directory")
+        self.parser.add_argument("--names", type=str, nargs='*', default=None, help="files to list, every file under root by default")
+        self.parser.add_argument("--check", action="store_true", help="verify the files against the manifest instead of writing it")
+        self.parser.add_argument("--workers", type=int, default=4, help="files hashed in parallel")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+
+class ModelStoreError(RuntimeError):
+    pass
+
+
+class ModelNotFound(ModelStoreError, FileNotFoundError):
+    pass
+
+
+class ChecksumMismatch(ModelStoreError, ValueError):
+    pass
+
+
+def file_digest(path: str, chunk_size: int = 1 << 24) -> str:
+    # hashlib releases the GIL on large updates, so several files hash in parallel on threads
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelStore():
+    '''
+    Resolves model artifacts by name to files under a local directory, checked against its manifest.
+
+    A name that is not in the directory is handed to `fetch` (a download, returning the local path),
+    unless the store is `offline`, in which case it is an error. A resolved name is verified once
+    (sha256 when `verify`, only the size otherwise) and remembered. A file whose size and mtime
+    are the same as when it last matched its sha256 is not hashed again.
+    '''
+    def __init__(self, root: Optional[str] = None, offline: bool = False, fetch: Optional[Callable[[str], str]] = None,
+                 verify: bool = True, workers: int = 4):
+        self.root = root
+        self.offline = offline
+        self.fetch = fetch
+        self.verify = verify
+        self.workers = workers
+        self.manifest: Dict[str, Dict] = {}
+        if root is not None and os.path.exists(os.path.join(root, MANIFEST)):
+            with open(os.path.join(root, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        self.verified: Dict[str, Dict] = {}
+        if root is not None and os.path.exists(os.path.join(root, VERIFIED)):
+            try:
+                with open(os.path.join(root, VERIFIED)) as f:
+                    self.verified = json.load(f)
+            except ValueError:
+                pass
+        self._resolved: Dict[str, str] = {}
+        self._unverified: List[str] = []
+        self._lock = threading.Lock()
+
+    def resolve(self, name: str) -> str:
+        with self._lock:
+            if name in self._resolved:
+                return self._resolved[name]
+        path = os.path.join(self.root, name) if self.root is not None else None
+        if path is None or not os.path.isfile(path):
+            # fetch gives None for names it does not know either
+            path = self.fetch(name) if not self.offline and self.fetch is not None else None
+            if path is None:
+                raise ModelNotFound('{} is not in the model store {}{}'.format(
+                    name, self.root, ' (offline)' if self.offline else ''))
+        self._check(name, path)
+        with self._lock:
+            self._resolved[name] = path
+        return path
+
+    def _check(self, name: str, path: str):
+        entry = self.manifest.get(name)
+        if entry is None:
+            with self._lock:
+                self._unverified.append(name)
+            return
+        size = os.path.getsize(path)
+        if size != entry['size']:
+            raise ChecksumMismatch('{} is {} bytes, the manifest says {}'.format(path, size, entry['size']))
+        if not self.verify:
+            return
+        stamp = {'sha256': entry['sha256'], 'size': size, 'mtime_ns': os.stat(path).st_mtime_ns}
+        with self._lock:
+            if self.verified.get(name) == stamp:
+                return
+        digest = file_digest(path)
+        if digest != entry['sha256']:
+            raise ChecksumMismatch('sha256 of {} is {}, the manifest says {}'.format(path, digest[:16], entry['sha256'][:16]))
+        with self._lock:
+            self.verified[name] = stamp
+            self._save_verified()
+
+    def _save_verified(self):
+        # best effort, a read-only store is hashed on every start
+        try:
+            tmp_path = os.path.join(self.root, VERIFIED + '.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(self.verified, indent=4))
+            os.replace(tmp_path, os.path.join(self.root, VERIFIED))
+        except (OSError, TypeError):
+            pass
+
+    def resolve_all(self, names: Iterable[str]) -> Dict[str, str]:
+        # one pass at start-up, files are fetched and hashed in parallel and every failure is
+        # reported together instead of one per restart
+        names = list(dict.fromkeys(names))
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='model-store') as executor:
+            futures = {name: executor.submit(self.resolve, name) for name in names}
+        errors = [future.exception() for future in futures.values() if future.exception() is not None]
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise ModelStoreError('{} model files failed:\n{}'.format(len(errors), '\n'.join(str(e) for e in errors))) from errors[0]
+        return {name: future.result() for name, future in futures.items()}
+
+    def unverified(self) -> List[str]:
+        # resolved names the manifest has no entry for
+        with self._lock:
+            return list(self._unverified)
+
+    def write_manifest(self, names: Optional[Iterable[str]] = None):
+        if names is None:
+            names = sorted(os.path.relpath(os.path.join(directory, f), self.root)
+                           for directory, _, files in os.walk(self.root) for f in files if f not in (MANIFEST, VERIFIED))
+        names = list(names)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = list(executor.map(lambda name: file_digest(os.path.join(self.root, name)), names))
+        self.manifest = {name: {'sha256': digest, 'size': os.path.getsize(os.path.join(self.root, name))}
+                         for name, digest in zip(names, digests)}
+        tmp_path = os.path.join(self.root, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(self.manifest, indent=4))
+        os.replace(tmp_path, os.path.join(self.root, MANIFEST))
+
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    store = ModelStore(args.root, offline=True, workers=args.workers)
+    if args.check:
+        # every file is hashed, not only the ones that changed
+        store.verified = {}
+        try:
+            resolved = store.resolve_all(args.names if args.names is not None else store.manifest.keys())
+        except ModelStoreError as e:
+            sys.exit(str(e))
+        print('{} files match the manifest'.format(len(resolved) - len(store.unverified())))
+        for name in store.unverified():
+            print('not in the manifest: {}'.format(name))
+    else:
+        store.write_manifest(args.names)
+        print('wrote {} entries to {}'.format(len(store.manifest), os.path.join(args.root, MANIFEST)))
@@ -0,0 +1,215 @@
+import os
+import inspect
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from model.vtoonify import VToonify
+from model.bisenet.model import BiSeNet
+from model.encoder.encoders.psp_encoders import GradualStyleEncoder
+
+# the lowest that exports the bilinear align_corners=True upsampling of BiSeNet: Resize only has a
+# coordinate_transformation_mode from opset 11 on. torch 1.7 exports up to opset 12
+OPSET = 11
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Export VToonify, BiSeNet and the pSp Encoder to ONNX")
+        self.parser.add_argument("--ckpt", type=str, default='./checkpoint/vtoonify_d_cartoon/vtoonify_s299_d0.5.pt', help="path of the vtoonify checkpoint")
+        self.parser.add_argument("--faceparsing_path", type=str, default='./checkpoint/faceparsing.pth', help="path of the face parsing model")
+        self.parser.add_argument("--style_encoder_path", type=str, default='./checkpoint/encoder.pt', help="path of the style encoder")
+        self.parser.add_argument("--size", type=int, default=256, help="height and width of the frames the graphs are traced with")
+        self.parser.add_argument("--opset", type=int, default=OPSET, help="onnx opset version")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+
+def onnx_path(path: str) -> str:
+    # the graph of a checkpoint is saved next to it, x.pt -> x.onnx
+    return os.path.splitext(path)[0] + '.onnx'
+
+
+def _export(module: nn.Module, args, path: str, input_names: List[str], output_names: List[str],
+            dynamic_axes: Dict[str, Dict[int, str]], opset: int = OPSET):
+    kwargs = {}
+    # newer torch defaults to the torch.export based exporter, these graphs are traced
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    tmp_path = path + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(module, args, tmp_path, opset_version=opset, input_names=input_names, output_names=output_names,
+                          dynamic_axes=dynamic_axes, do_constant_folding=True, **kwargs)
+    os.replace(tmp_path, path)
+
+
+class _NoNoise(nn.Module):
+    # VToonify always injects zero noise
+    def forward(self, image, noise=None):
+        return image
+
+
+class _VToonifyGraph(nn.Module):
+    def __init__(self, vtoonify: VToonify):
+        super().__init__()
+        self.vtoonify = vtoonify
+
+    def forward(self, x, style, d_s):
+        return self.vtoonify(x, style, d_s=d_s)
+
+
+@contextmanager
+def _traceable(vtoonify: VToonify):
+    # the plain forward without noise layers, the in place copies of the lean path do not export
+    lean = vtoonify.lean
+    convs = vtoonify.stylegan().convs
+    noises = {i: conv.noise for i, conv in enumerate(convs) if hasattr(conv, 'noise')}
+    vtoonify.lean = False
+    for i in noises:
+        convs[i].noise = _NoNoise()
+    try:
+        yield
+    finally:
+        vtoonify.lean = lean
+        for i, noise in noises.items():
+            convs[i].noise = noise
+
+
+def export_vtoonify(vtoonify: VToonify, path: str, size: int = 256, opset: int = OPSET):
+    # traced for one frame: with a batch, the modulated convolutions would be fixed to its size.
+    # the style degree is an input, d_s = 0 gives the same output as the skipped ModRes blocks
+    device = next(vtoonify.parameters()).device
+    x = torch.randn(1, 22, size, size, device=device)
+    style = torch.randn(1, vtoonify.generator.n_latent, vtoonify.style_channels, device=device)
+    d_s = torch.tensor([0.5], device=device)
+    with _traceable(vtoonify):
+        _export(_VToonifyGraph(vtoonify).eval(), (x, style, d_s), path, ['x', 'style', 'd_s'], ['y'],
+                {'x': {2: 'height', 3: 'width'}, 'y': {2: 'out_height', 3: 'out_width'}}, opset)
+
+
+class _FirstOutput(nn.Module):
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, x):
+        return self.module(x)[0]
+
+
+def export_parsing(parsingpredictor: BiSeNet, path: str, size: int = 512, opset: int = OPSET):
+    # only the main output, the auxiliary heads are for training
+    x = torch.randn(1, 3, size, size, device=next(parsingpredictor.parameters()).device)
+    _export(_FirstOutput(parsingpredictor).eval(), (x,), path, ['x'], ['parsing'],
+            {'x': {0: 'batch', 2: 'height', 3: 'width'}, 'parsing': {0: 'batch', 2: 'height', 3: 'width'}}, opset)
+
+
+def export_psp(pspencoder: GradualStyleEncoder, path: str, size: int = 256, opset: int = OPSET):
+    # the latent_avg hook is part of the graph. other sizes than 256 give several codes per frame
+    x = torch.randn(1, 3, size, size, device=next(pspencoder.parameters()).device)
+    _export(pspencoder.eval(), (x,), path, ['x'], ['codes'],
+            {'x': {0: 'batch', 2: 'height', 3: 'width'}, 'codes': {0: 'codes'}}, opset)
+
+
+def new_inference_session(path: str, device: str = 'cpu'):
+    import onnxruntime as ort
+    sess_opts = ort.SessionOptions()
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # the frame size changes between calls, memory planned or pooled for one shape is not reused
+    sess_opts.enable_mem_pattern = False
+    sess_opts.enable_cpu_mem_arena = False
+    if "OMP_NUM_THREADS" in os.environ:
+        sess_opts.intra_op_num_threads = int(os.environ["OMP_NUM_THREADS"])
+    providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if device == 'cuda' else ['CPUExecutionProvider']
+    return ort.InferenceSession(path, sess_options=sess_opts, providers=providers)
+
+
+class OrtModule(nn.Module):
+    '''
+    An exported graph, called like the torch module it came from. The onnxruntime session is
+    made on first use in each process, it is not fork safe (see WorkerPool).
+    '''
+    def __init__(self, path: str, device: str = 'cpu'):
+        super().__init__()
+        if not os.path.isfile(path):
+            raise FileNotFoundError('{} does not exist, export it with onnx_backend.py'.format(path))
+        self.path = path
+        self.device = device
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                self._session = new_inference_session(self.path, self.device)
+                self._pid = os.getpid()
+            return self._session
+
+    def run(self, **inputs: torch.Tensor) -> List[torch.Tensor]:
+        outputs = self.session().run(None, {name: tensor.detach().cpu().numpy() for name, tensor in inputs.items()})
+        return [torch.from_numpy(output).to(self.device) for output in outputs]
+
+
+class OrtVToonify(OrtModule):
+    def __init__(self, path: str, vtoonify: VToonify, device: str = 'cpu'):
+        super().__init__(path, device)
+        self.backbone = vtoonify.backbone
+        self.backbone_path = getattr(vtoonify, 'backbone_path', None)
+        # zplus2wplus stays in torch, only the mapping network of the generator is kept
+        self.mapping = vtoonify.stylegan().style
+
+    def zplus2wplus(self, zplus):
+        return self.mapping(zplus.reshape(zplus.shape[0]*zplus.shape[1], zplus.shape[2])).reshape(zplus.shape)
+
+    def forward(self, x, style, d_s=1):
+        # the graph takes one frame (see export_vtoonify), a batch runs frame by frame
+        d_s = torch.tensor([d_s], dtype=torch.float32)
+        style = style.expand(x.size(0), -1, -1) if style.size(0) == 1 else style
+        return torch.cat([self.run(x=x[i:i+1], style=style[i:i+1], d_s=d_s)[0] for i in range(x.size(0))], dim=0)
+
+
+class OrtBiSeNet(OrtModule):
+    def forward(self, x):
+        # a tuple like BiSeNet, callers take [0]
+        return tuple(self.run(x=x))
+
+
+class OrtStyleEncoder(OrtModule):
+    def forward(self, x):
+        return self.run(x=x)[0]
+
+
+if __name__ == "__main__":
+    from delta_checkpoint import read_vtoonify_checkpoint
+    from util import load_psp_standalone
+
+    parser = Options()
+    args = parser.parse()
+
+    def load_vtoonify():
+        state_dict, pruned, _ = read_vtoonify_checkpoint(args.ckpt)
+        # a checkpoint without res.* blocks was trained on the toonify backbone
+        vtoonify = VToonify(backbone='dualstylegan' if any(k.startswith('res.') for k in state_dict) else 'toonify')
+        if pruned:
+            vtoonify.prune_for_inference()
+        vtoonify.load_state_dict(state_dict)
+        return vtoonify.eval()
+
+    def load_parsing():
+        parsingpredictor = BiSeNet(n_classes=19, pretrained_backbone=False)
+        parsingpredictor.load_state_dict(torch.load(args.faceparsing_path, map_location=lambda storage, loc: storage))
+        return parsingpredictor.eval()
+
+    # one model at a time, tracing holds a second copy of the weights
+    for load, export, path, size in ((lambda: load_psp_standalone(args.style_encoder_path, 'cpu'), export_psp, args.style_encoder_path, args.size),
+                                     (load_vtoonify, export_vtoonify, args.ckpt, args.size),
+                                     (load_parsing, export_parsing, args.faceparsing_path, args.size * 2)):
+        export(load(), onnx_path(path), size, args.opset)
+        print('saved {} ({:.1f} MB)'.format(onnx_path(path), os.path.getsize(onnx_path(path)) / 2**20))
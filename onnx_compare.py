@@ -0,0 +1,86 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from style_transfer import create_image_style_transfer_dualstylegan_models, stylize_crops
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Parity and Latency of the ONNX Backend against PyTorch")
+        self.parser.add_argument("--ckpt", type=str, default='./checkpoint/vtoonify_d_cartoon/vtoonify_s299_d0.5.pt', help="path of the vtoonify checkpoint")
+        self.parser.add_argument("--faceparsing_path", type=str, default='./checkpoint/faceparsing.pth', help="path of the face parsing model")
+        self.parser.add_argument("--style_encoder_path", type=str, default='./checkpoint/encoder.pt', help="path of the style encoder")
+        self.parser.add_argument("--exstyle_path", type=str, default='./checkpoint/vtoonify_d_cartoon/exstyle_code.npy', help="path of the extrinsic style code")
+        self.parser.add_argument("--sizes", type=int, nargs='+', default=[256, 320], help="crop sizes to compare, the graphs have dynamic spatial axes")
+        self.parser.add_argument("--runs", type=int, default=3, help="timed calls per model after one warm-up call, the median is reported")
+        self.parser.add_argument("--tolerance", type=float, default=1e-3, help="fail when an output differs by more than this")
+        self.parser.add_argument("--output", type=str, default=None, help="also write the json report to this path")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+def timed(fn, runs):
+    # the first call sets up the onnxruntime session and the allocators, it is not counted
+    output = fn()
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        output = fn()
+        times.append((time.time() - start) * 1000)
+    return output, float(np.median(times))
+
+def compare(name, torch_fn, onnx_fn, runs):
+    expected, torch_ms = timed(torch_fn, runs)
+    output, onnx_ms = timed(onnx_fn, runs)
+    max_diff = (expected - output).abs().max().item() if torch.is_tensor(expected) else float(np.abs(expected - output).max())
+    print('{}: max diff {:.2e}, torch {:.0f} ms, onnx {:.0f} ms'.format(name, max_diff, torch_ms, onnx_ms), file=sys.stderr)
+    return {'max_diff': max_diff, 'torch_ms': torch_ms, 'onnx_ms': onnx_ms}
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    # onnxruntime runs on the cpu here, the torch models too so that the latencies compare
+    paths = (args.ckpt, args.faceparsing_path, args.style_encoder_path, args.exstyle_path)
+    torch_models = create_image_style_transfer_dualstylegan_models(0, 'cpu', *paths, backend='torch')
+    onnx_models = create_image_style_transfer_dualstylegan_models(0, 'cpu', *paths, backend='onnx')
+    vtoonify, parsingpredictor, pspencoder, exstyles = torch_models
+    ort_vtoonify, ort_parsing, ort_psp, _ = onnx_models
+
+    report = {}
+    with torch.no_grad():
+        for size in args.sizes:
+            # each model gets the same inputs, from the torch chain, so that differences do not add up
+            x = torch.rand(1, 3, size, size) * 2 - 1
+            s_w = vtoonify.zplus2wplus(pspencoder(x)[:1])
+            s_w[:, :7] = exstyles.codes[[exstyles.lookup(exstyles.default)]][:, :7]
+            x_p = F.interpolate(parsingpredictor(2*F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False))[0],
+                                scale_factor=0.5, recompute_scale_factor=False)
+            inputs = torch.cat((x, x_p/16.), dim=1)
+            crop = np.random.randint(0, 256, (size, size, 3), dtype=np.uint8)
+
+            report[size] = {
+                'psp': compare('psp {}'.format(size), lambda: pspencoder(x), lambda: ort_psp(x), args.runs),
+                'parsing': compare('parsing {}'.format(size), lambda: parsingpredictor(2*F.interpolate(x, scale_factor=2))[0],
+                                   lambda: ort_parsing(2*F.interpolate(x, scale_factor=2))[0], args.runs),
+                'vtoonify': compare('vtoonify {}'.format(size), lambda: vtoonify(inputs, s_w, d_s=0.5),
+                                    lambda: ort_vtoonify(inputs, s_w, d_s=0.5), args.runs),
+                # the whole chain of stylize_crops, in [0, 1]
+                'stylize': compare('stylize {}'.format(size), lambda: stylize_crops([crop], 'cpu', torch_models)[0],
+                                   lambda: stylize_crops([crop], 'cpu', onnx_models)[0], args.runs),
+            }
+
+    print(json.dumps(report, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    worst = max(result['max_diff'] for models in report.values() for result in models.values())
+    if worst > args.tolerance:
+        sys.exit('the onnx backend differs by up to {:.2e}'.format(worst))
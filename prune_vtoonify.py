@@ -0,0 +1,72 @@
+import os
+import argparse
+from typing import Dict
+
+import torch
+from torch import nn
+
+from model.vtoonify import VToonify
+from delta_checkpoint import read_vtoonify_checkpoint
+
+
+class Options():
+    def __init__(self):
+
+        self.parser = argparse.ArgumentParser(description="Export Inference-Only VToonify Checkpoints without the Unused Generator Layers")
+        self.parser.add_argument("ckpts", type=str, nargs='+', help="vtoonify checkpoints, full or delta, e.g. checkpoint/vtoonify_d_cartoon/*.pt")
+        self.parser.add_argument("--suffix", type=str, default='_pruned', help="the pruned model of x.pt is saved as x{suffix}.pt")
+        self.parser.add_argument("--size", type=int, default=64, help="height and width of the random input of the parity check")
+        self.parser.add_argument("--tolerance", type=float, default=1e-5, help="largest output difference the parity check accepts")
+
+    def parse(self):
+        self.opt = self.parser.parse_args()
+        return self.opt
+
+
+def tensor_bytes(module: nn.Module) -> Dict[str, int]:
+    return {'parameters': sum(p.numel() * p.element_size() for p in module.parameters()),
+            'buffers': sum(b.numel() * b.element_size() for b in module.buffers())}
+
+
+def check_parity(vtoonify: VToonify, size: int = 64) -> float:
+    # prunes vtoonify in place and returns the largest difference of its output before and after,
+    # for a random frame, style and style degree
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(1, 22, size, size, generator=generator)
+    style = torch.randn(1, vtoonify.generator.n_latent, vtoonify.style_channels, generator=generator)
+    with torch.no_grad():
+        expected = vtoonify(x, style, d_s=0.5)
+        vtoonify.prune_for_inference()
+        output = vtoonify(x, style, d_s=0.5)
+    return (expected - output).abs().max().item()
+
+
+if __name__ == "__main__":
+
+    parser = Options()
+    args = parser.parse()
+
+    for ckpt_path in args.ckpts:
+        state_dict, pruned, _ = read_vtoonify_checkpoint(ckpt_path)
+        if pruned:
+            print('skip {}, already pruned'.format(ckpt_path))
+            continue
+        # a checkpoint without res.* blocks was trained on the toonify backbone
+        arch = 'dualstylegan' if any(k.startswith('res.') for k in state_dict) else 'toonify'
+        vtoonify = VToonify(backbone=arch)
+        vtoonify.load_state_dict(state_dict)
+        vtoonify.eval()
+        before = tensor_bytes(vtoonify)
+        max_diff = check_parity(vtoonify, args.size)
+        after = tensor_bytes(vtoonify)
+        if max_diff > args.tolerance:
+            raise RuntimeError('{}: the pruned model differs by {:.2e}'.format(ckpt_path, max_diff))
+
+        pruned_path = os.path.splitext(ckpt_path)[0] + args.suffix + '.pt'
+        # the flag tells the loaders to prune the model before loading this state into it
+        torch.save({'g_ema': vtoonify.state_dict(), 'pruned': True}, pruned_path)
+        print('{}: parameters {:.1f} MB -> {:.1f} MB, buffers {:.1f} MB -> {:.1f} MB, max diff {:.2e}'.format(
+            ckpt_path, before['parameters'] / 2**20, after['parameters'] / 2**20,
+            before['buffers'] / 2**20, after['buffers'] / 2**20, max_diff))
+        print('saved {} ({:.1f} MB, was {:.1f} MB)'.format(
+            pruned_path, os.path.getsize(pruned_path) / 2**20, os.path.getsize(ckpt_path) / 2**20))
@@ -0,0 +1,90 @@
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Generic, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class PoolTimeout(TimeoutError):
+    pass
+
+
+class ResourcePool(Generic[T]):
+    '''
+    Hands out instances of a stateful component (face detector, landmark predictor, onnxruntime
+    session) to one thread at a time.
+
+    Instances are built with `factory` on first demand, up to `size` of them, and are reused
+    afterwards. A thread that finds all of them checked out waits for one to come back.
+    '''
+    def __init__(self, factory: Callable[[], T], size: int = 1, name: str = 'pool'):
+        if size < 1:
+            raise ValueError('pool size must be at least 1, got {}'.format(size))
+        self.factory = factory
+        self.size = size
+        self.name = name
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checked_out = 0
+        self._waits = 0
+
+    @contextmanager
+    def checkout(self, timeout: Optional[float] = None):
+        instance = self._acquire(timeout)
+        try:
+            yield instance
+        finally:
+            with self._lock:
+                self._checked_out -= 1
+            self._idle.put(instance)
+
+    def _acquire(self, timeout: Optional[float]) -> T:
+        try:
+            instance = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                build = self._created < self.size
+                if build:
+                    self._created += 1
+                else:
+                    self._waits += 1
+            if build:
+                try:
+                    instance = self.factory()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    instance = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise PoolTimeout('no free {} instance after {}s'.format(self.name, timeout))
+        with self._lock:
+            self._checked_out += 1
+        return instance
+
+    def resize(self, size: int):
+        # only grows or caps future construction, instances already built stay around
+        if size < 1:
+            raise ValueError('pool size must be at least 1, got {}'.format(size))
+        with self._lock:
+            self.size = size
+
+    def reset(self):
+        # forget every idle instance, e.g. in a forked child where the parent's ones are unusable
+        with self._lock:
+            self._idle = queue.LifoQueue()
+            self._created = 0
+            self._checked_out = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'checked_out': self._checked_out,
+                'waits': self._waits,
+            }
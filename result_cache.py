@@ -0,0 +1,106 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+
+class ResultCache():
+    '''
+    LRU cache of encoded responses, keyed by a digest of the request.
+    Every entry is the encoded image plus a small json-serializable metadata dict.
+
+    The memory tier is bounded by entry count. The optional disk tier keeps one file per key
+    (and a json sidecar for the metadata) under `cache_dir` and is bounded by total bytes;
+    a disk hit is promoted to memory.
+    '''
+    def __init__(self,
+                 max_entries: int = 256,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 max_disk_bytes: int = 1 << 30):
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()   # key -> file size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            files = sorted(self.cache_dir.glob('*.bin'), key=lambda f: f.stat().st_mtime)
+            for f in files:
+                size = f.stat().st_size
+                self._disk[f.stem] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, Dict]]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._counters['hits'] += 1
+                return self._memory[key]
+            if key in self._disk:
+                try:
+                    value = (self._path(key).read_bytes(),
+                             json.loads(self._path(key).with_suffix('.json').read_text()))
+                except (OSError, ValueError):
+                    self._drop_disk(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._counters['disk_hits'] += 1
+                    self._put_memory(key, value)
+                    return value
+            self._counters['misses'] += 1
+            return None
+
+    def put(self, key: str, value: bytes, meta: Optional[Dict] = None):
+        meta = meta or {}
+        with self._lock:
+            self._put_memory(key, (value, meta))
+            if self.cache_dir is not None and key not in self._disk and len(value) <= self.max_disk_bytes:
+                # write then rename, so a concurrent reader never sees a partial file
+                path = self._path(key)
+                tmp = path.with_suffix('.tmp')
+                tmp.write_text(json.dumps(meta))
+                os.replace(tmp, path.with_suffix('.json'))
+                tmp.write_bytes(value)
+                os.replace(tmp, path)
+                self._disk[key] = len(value)
+                self._disk_bytes += len(value)
+                self._evict_disk()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._memory)
+            stats['disk_entries'] = len(self._disk)
+            stats['disk_bytes'] = self._disk_bytes
+            return stats
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / (key + '.bin')
+
+    def _put_memory(self, key: str, value: Tuple[bytes, Dict]):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _drop_disk(self, key: str):
+        self._disk_bytes -= self._disk.pop(key)
+        for path in (self._path(key), self._path(key).with_suffix('.json')):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            self._drop_disk(next(iter(self._disk)))
+            self._counters['disk_evictions'] += 1
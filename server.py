@@ -5,8 +5,9 @@ def create_app():
   app = Flask(__name__,
     static_url_path='',
     static_folder='./dist')
-  from bp import anime_style_transfer
+  from bp import anime_style_transfer, health
   app.register_blueprint(anime_style_transfer.bp)
+  app.register_blueprint(health.bp)
 
   cors = CORS(app)
   app.config['CORS_HEADERS'] = 'Content-Type'
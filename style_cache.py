@@ -0,0 +1,221 @@
+import copy
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional
+
+import torch
+from torch import nn
+
+from model.vtoonify import VToonify
+from inference_bundle import skip_init
+from delta_checkpoint import TRAINABLE_PREFIXES, FORMAT, split_state_dict, backbone_fingerprint, read_vtoonify_checkpoint
+
+# submodules of VToonify that differ between styles, the rest (generator, res) is the frozen backbone
+TRAINABLE_MODULES = tuple(prefix.rstrip('.') for prefix in TRAINABLE_PREFIXES)
+
+
+def _module_bytes(modules: Iterable[nn.Module]) -> int:
+    return sum(t.numel() * t.element_size() for m in modules for t in list(m.parameters()) + list(m.buffers()))
+
+
+class _Skipped(Exception):
+    pass
+
+
+class _Family():
+    # one frozen backbone on the device, shared by every resident style trained on it
+    def __init__(self, fingerprint: str, modules: Dict[str, nn.Module]):
+        self.fingerprint = fingerprint
+        self.modules = modules
+        self.nbytes = _module_bytes(modules.values())
+        self.styles = set()
+
+
+class StyleCache():
+    '''
+    VToonify models of many checkpoints, resident on the device at the same time.
+
+    Checkpoints whose frozen weights have the same fingerprint share one copy of the generator
+    and ModRes blocks, each style only adds its encoder and fusion layers. Switching to a resident
+    style returns the model that is already there. Styles are evicted least recently used first
+    once the resident weights exceed `max_bytes`, and a backbone goes with its last style. An
+    evicted model is only freed once its callers drop it too, e.g. the style currently in use,
+    `stats()` counts those as `evicted_in_use`.
+
+    Styles are keyed by checkpoint path, or by any name that `resolve` turns into one (e.g. a
+    download), which then also happens in the background for a prefetch.
+    '''
+    def __init__(self, device: str = 'cuda', max_bytes: int = 3 << 30, backbone: str = 'dualstylegan', prefetch_workers: int = 1,
+                 resolve: Optional[Callable[[str], str]] = None):
+        self.device = device
+        self.resolve = resolve
+        self.max_bytes = max_bytes
+        self.backbone = backbone
+
+        self._styles = OrderedDict()   # key -> (model, family, own bytes), oldest first
+        self._families = {}            # fingerprint -> _Family
+        self._pending = {}             # key -> Future of a load in progress
+        self._evicted = weakref.WeakSet()  # evicted models something still holds on to
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='style-prefetch') \
+            if prefetch_workers > 0 else None
+        self._counters = {'hits': 0, 'misses': 0, 'prefetched': 0, 'evictions': 0, 'shared_backbones': 0}
+
+    def get(self, key: str) -> VToonify:
+        with self._lock:
+            if key in self._styles:
+                self._styles.move_to_end(key)
+                self._counters['hits'] += 1
+                return self._styles[key][0]
+            self._counters['misses'] += 1
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if owner:
+            self._load(key, future, prefetch=False)
+        # a prefetch of the same checkpoint may be on the way, wait for it instead of loading twice
+        try:
+            model = future.result()
+        except _Skipped:
+            # the prefetch gave up for lack of room, load it for real
+            return self.get(key)
+        with self._lock:
+            if key in self._styles:
+                self._styles.move_to_end(key)
+        return model
+
+    def prefetch(self, keys: Iterable[str]):
+        # loads in the background, but only what fits without evicting anything
+        if self._executor is None:
+            return
+        for key in keys:
+            with self._lock:
+                if key in self._styles or key in self._pending:
+                    continue
+                future = self._pending[key] = Future()
+            self._executor.submit(self._load, key, future, True)
+
+    def _load(self, key: str, future: Future, prefetch: bool):
+        try:
+            ckpt_path = self.resolve(key) if self.resolve is not None else key
+            delta, fingerprint, state_dict, pruned = self._read(ckpt_path)
+            with self._lock:
+                family = self._families.get(fingerprint)
+                # a registered family always has a resident style
+                template = self._styles[next(iter(family.styles))][0] if family is not None else None
+                resident_bytes = self._resident_bytes()
+            if family is None:
+                if prefetch and resident_bytes > 0:
+                    # a new backbone is large, prefetching it would evict the styles in use
+                    raise _Skipped()
+                with skip_init():
+                    model = VToonify(backbone=self.backbone)
+                if state_dict is None:
+                    state_dict, pruned, _ = read_vtoonify_checkpoint(ckpt_path)
+                if pruned:
+                    model.prune_for_inference()
+                model.load_state_dict(state_dict)
+                model.to(self.device)
+                family = _Family(fingerprint, self._frozen_modules(model))
+            else:
+                model = self._derive(template, family)
+                for name in TRAINABLE_MODULES:
+                    getattr(model, name).load_state_dict({k[len(name)+1:]: v for k, v in delta.items() if k.startswith(name + '.')})
+                    getattr(model, name).to(self.device)
+            nbytes = _module_bytes(getattr(model, name) for name in TRAINABLE_MODULES)
+
+            with self._lock:
+                if prefetch and self._resident_bytes() + nbytes + (family.nbytes if not family.styles else 0) > self.max_bytes:
+                    raise _Skipped()
+                registered = self._families.setdefault(fingerprint, family)
+                if registered is not family:
+                    # another load brought the same backbone in meanwhile, the one already there is used
+                    self._attach(model, registered)
+                    family = registered
+                if family.styles:
+                    self._counters['shared_backbones'] += 1
+                family.styles.add(key)
+                self._styles[key] = (model, family, nbytes)
+                if prefetch:
+                    self._counters['prefetched'] += 1
+                    # stays first in line for eviction until it is asked for
+                    self._styles.move_to_end(key, last=False)
+                self._evict(keep=key)
+                del self._pending[key]
+            future.set_result(model)
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(key, None)
+            future.set_exception(e)
+            if not prefetch:
+                raise
+
+    def _read(self, ckpt_path: str):
+        # the trainable weights, the backbone fingerprint and, for a full checkpoint, the whole state
+        # and whether it was pruned. a delta is not composed with its backbone file unless that
+        # backbone is not resident yet
+        ckpt = torch.load(ckpt_path, map_location='cpu')
+        if ckpt.get('format') == FORMAT:
+            return ckpt['g_ema_delta'], ckpt['backbone_fingerprint'], None, False
+        delta, backbone = split_state_dict(ckpt['g_ema'])
+        return delta, backbone_fingerprint(backbone), ckpt['g_ema'], ckpt.get('pruned', False)
+
+    @staticmethod
+    def _frozen_modules(model: VToonify) -> Dict[str, nn.Module]:
+        return {name: module for name, module in model.named_children() if name not in TRAINABLE_MODULES}
+
+    @staticmethod
+    def _derive(template: VToonify, family: _Family) -> VToonify:
+        # a new style on a resident backbone, without building (or initializing) a whole VToonify:
+        # the frozen modules are the family's, the trainable ones copies of another style's that
+        # the caller overwrites
+        model = VToonify.__new__(VToonify)
+        nn.Module.__init__(model)
+        for name, value in template.__dict__.items():
+            model.__dict__.setdefault(name, value)
+        for name, module in template.named_children():
+            model._modules[name] = family.modules[name] if name in family.modules else copy.deepcopy(module)
+        model.training = template.training
+        # the buffers of lean_inference are per model
+        model.lean, model.arena = False, None
+        return model
+
+    @staticmethod
+    def _attach(model: VToonify, family: _Family):
+        # the uninitialized frozen modules of a new model are replaced by the shared ones
+        for name, module in family.modules.items():
+            setattr(model, name, module)
+
+    def _resident_bytes(self) -> int:
+        return sum(nbytes for _, _, nbytes in self._styles.values()) + \
+            sum(family.nbytes for family in self._families.values())
+
+    def _evict(self, keep: str):
+        while self._resident_bytes() > self.max_bytes:
+            key = next((k for k in self._styles if k != keep), None)
+            if key is None:
+                break
+            model, family, _ = self._styles.pop(key)
+            self._evicted.add(model)
+            family.styles.discard(key)
+            if not family.styles:
+                del self._families[family.fingerprint]
+            self._counters['evictions'] += 1
+
+    def resident(self):
+        with self._lock:
+            return list(self._styles)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['styles'] = len(self._styles)
+            stats['backbones'] = len(self._families)
+            stats['resident_bytes'] = self._resident_bytes()
+            stats['max_bytes'] = self.max_bytes
+            # not in resident_bytes, but their weights are still allocated
+            stats['evicted_in_use'] = len(self._evicted)
+            return stats
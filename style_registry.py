@@ -0,0 +1,57 @@
+from typing import Dict, List, Union
+
+import numpy as np
+import torch
+
+from exstyle_store import ExstyleStore
+
+
+class StyleRegistry():
+    '''
+    All extrinsic style codes of a checkpoint, already mapped to W+ space.
+
+    `codes` is one contiguous (n_styles, 18, 512) tensor, so picking a style per request is an
+    index into it. Styles can be referred to by index or by the name they have in exstyle_code.npy.
+    '''
+    def __init__(self, codes: torch.Tensor, names: List[str], default: int = 0):
+        self.codes = codes
+        self.names = names
+        self.index: Dict[str, int] = {name: i for i, name in enumerate(names)}
+        self.default = self.lookup(default)
+
+    @classmethod
+    def from_file(cls, exstyle_path: str, vtoonify, device: str = 'cuda', default: int = 0,
+                  use_stored_wplus: bool = False) -> 'StyleRegistry':
+        return cls.from_store(ExstyleStore.open(exstyle_path), vtoonify, device, default, use_stored_wplus)
+
+    @classmethod
+    def from_store(cls, store: ExstyleStore, vtoonify, device: str = 'cuda', default: int = 0,
+                   use_stored_wplus: bool = False) -> 'StyleRegistry':
+        # use_stored_wplus takes the W+ table of the compact store (see exstyle_store.py) as is,
+        # which skips the mapping network but may be float16 precision
+        if use_stored_wplus and store.wplus is not None:
+            codes = torch.from_numpy(np.array(store.wplus, dtype=np.float32)).to(device)
+            return cls(codes, store.names, default)
+        zplus = torch.from_numpy(np.array(store.codes, dtype=np.float32)).to(device)
+        with torch.no_grad():
+            codes = vtoonify.zplus2wplus(zplus).contiguous()
+        return cls(codes, store.names, default)
+
+    def lookup(self, style: Union[int, str]) -> int:
+        if isinstance(style, str) and style in self.index:
+            return self.index[style]
+        try:
+            style_id = int(style)
+        except ValueError:
+            raise KeyError('unknown style {}'.format(style))
+        if not 0 <= style_id < len(self.names):
+            raise KeyError('style id {} out of range [0, {})'.format(style_id, len(self.names)))
+        return style_id
+
+    def __getitem__(self, style: Union[int, str]) -> torch.Tensor:
+        # keep the batch dimension, same as the single exstyle code used to be
+        style_id = self.lookup(style)
+        return self.codes[style_id:style_id+1]
+
+    def __len__(self) -> int:
+        return len(self.names)
@@ -4,19 +4,27 @@ import argparse
 import numpy as np
 import cv2
 import torch
-from torchvision import transforms
 import torch.nn.functional as F
 from tqdm import tqdm
 from model.vtoonify import VToonify
 from model.bisenet.model import BiSeNet
-from model.encoder.align_all_parallel import align_face
-from util import save_image, load_psp_standalone, get_video_crop_parameter, tensor2cv2, get_crop_parameter_by_mediapipe, creat_weight_kernel, create_weight_field
-import matplotlib.pyplot as plt
-from typing import Optional, List, Tuple
+from util import save_image, load_psp_standalone, get_video_crop_parameter, tensor2cv2, get_crop_parameter_by_mediapipe, new_face_detector, creat_weight_kernel, create_weight_field
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, List, Tuple
 from model.encoder.encoders.psp_encoders import GradualStyleEncoder
-from matting.rembg_simplify import remove
-from mediapipe.python.solutions.face_detection import FaceDetection
+from style_registry import StyleRegistry
+from exstyle_store import ExstyleStore
+from delta_checkpoint import load_vtoonify
+from inference_bundle import skip_init, load_models
+from onnx_backend import onnx_path, OrtVToonify, OrtBiSeNet, OrtStyleEncoder
+from metrics import stage_timer
 import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+# torchvision, mediapipe, dlib, matplotlib and the matting session are imported on first use
+if TYPE_CHECKING:
+    from mediapipe.python.solutions.face_detection import FaceDetection
+
+class ModelLoadError(RuntimeError):
+    pass
 
 class TestOptions():
     def __init__(self):
@@ -56,89 +64,205 @@ def create_image_style_transfer_dualstylegan_models(
         faceparsing_ckpt: str = './checkpoint/faceparsing.pth',
         pspencoder_ckpt: str = './checkpoint/encoder.pt',
         exstyle_path: str = './checkpoint/vtoonify_d_cartoon/exstyle_code.npy',    # usually in the same dir with ckpt
+        bundle: Optional[str] = None,    # packed by inference_bundle.py, replaces all the checkpoints above
+        use_stored_wplus: bool = False,    # take the W+ codes saved by exstyle_store.py instead of mapping them
+        load_times: Optional[Dict[str, float]] = None,    # filled with the ms each model took to load
+        max_workers: int = 4,
+        lean: bool = True,    # vtoonify.lean_inference, fewer temporaries in no_grad forwards
+        backend: str = 'torch',    # 'torch' | 'onnx', the graphs exported by onnx_backend.py run on onnxruntime
+        vtoonify_onnx: Optional[str] = None,    # the onnx graphs, next to their checkpoints by default
+        faceparsing_onnx: Optional[str] = None,
+        pspencoder_onnx: Optional[str] = None,
         ):
-    vtoonify = VToonify(backbone = 'dualstylegan')
-    print('loading ckpt: {}'.format(ckpt))
-    vtoonify.load_state_dict(torch.load(ckpt, map_location=lambda storage, loc: storage)['g_ema'])
-    vtoonify.to(device)
-
-    parsingpredictor = BiSeNet(n_classes=19)
-    parsingpredictor.load_state_dict(torch.load(faceparsing_ckpt, map_location=lambda storage, loc: storage))
-    parsingpredictor.to(device).eval()
-
-    pspencoder = load_psp_standalone(pspencoder_ckpt, device)
-
-    exstyles = np.load(exstyle_path, allow_pickle='TRUE').item()
-    stylename = list(exstyles.keys())[style_id]
-    exstyle = torch.tensor(exstyles[stylename]).to(device)
-    with torch.no_grad():  
-        exstyle = vtoonify.zplus2wplus(exstyle)
-
-    return vtoonify, parsingpredictor, pspencoder, exstyle
+    if backend not in ('torch', 'onnx'):
+        raise ValueError('unknown backend {}, expected torch or onnx'.format(backend))
+    if load_times is None:
+        load_times = {}
+    start = time.perf_counter()
+    if bundle is not None:
+        if backend != 'torch':
+            raise ValueError('a bundle holds torch weights, it only runs on the torch backend')
+        print('loading bundle: {}'.format(bundle))
+        models = load_models(bundle, device, style_id)
+        models[0].lean_inference(lean)
+        load_times['bundle'] = load_times['total'] = (time.perf_counter() - start) * 1000
+        return models
+
+    # the loaders are independent (deserialization and weight copies mostly release the GIL),
+    # only mapping the style codes to W+ needs vtoonify and runs once they are all done
+    def load_vtoonify():
+        with skip_init():
+            vtoonify = VToonify(backbone = 'dualstylegan')
+        # a full checkpoint or a delta on a shared backbone, see delta_checkpoint.py
+        load_vtoonify(vtoonify, ckpt)
+        vtoonify = vtoonify.to(device).lean_inference(lean)
+        if backend == 'onnx':
+            # the torch model is only kept for its style mapping, see OrtVToonify
+            return OrtVToonify(vtoonify_onnx or onnx_path(ckpt), vtoonify, device)
+        return vtoonify
+
+    def load_parsing():
+        with skip_init():
+            parsingpredictor = BiSeNet(n_classes=19, pretrained_backbone=False)
+        parsingpredictor.load_state_dict(torch.load(faceparsing_ckpt, map_location=lambda storage, loc: storage))
+        return parsingpredictor.to(device).eval()
+
+    def load_psp():
+        with skip_init():
+            return load_psp_standalone(pspencoder_ckpt, device)
+
+    loaders = {
+        'vtoonify': (ckpt, load_vtoonify),
+        'parsing': (faceparsing_ckpt, load_parsing),
+        'psp': (pspencoder_ckpt, load_psp),
+        'exstyles': (exstyle_path, lambda: ExstyleStore.open(exstyle_path)),
+    }
+    if backend == 'onnx':
+        faceparsing_onnx = faceparsing_onnx or onnx_path(faceparsing_ckpt)
+        pspencoder_onnx = pspencoder_onnx or onnx_path(pspencoder_ckpt)
+        loaders['parsing'] = (faceparsing_onnx, lambda: OrtBiSeNet(faceparsing_onnx, device))
+        loaders['psp'] = (pspencoder_onnx, lambda: OrtStyleEncoder(pspencoder_onnx, device))
+    loaded = load_concurrently(loaders, load_times, max_workers)
+    vtoonify = loaded['vtoonify']
+
+    # every style is mapped to W+ once here, requests then only index into the table
+    mapping_start = time.perf_counter()
+    exstyles = StyleRegistry.from_store(loaded['exstyles'], vtoonify, device, default=style_id, use_stored_wplus=use_stored_wplus)
+    load_times['exstyles'] += (time.perf_counter() - mapping_start) * 1000
+    load_times['total'] = (time.perf_counter() - start) * 1000
+    print('loaded models in {:.0f} ms ({})'.format(load_times['total'], ', '.join(
+        '{} {:.0f} ms'.format(name, ms) for name, ms in load_times.items() if name != 'total')))
+
+    return vtoonify, loaded['parsing'], loaded['psp'], exstyles
+
+def load_concurrently(
+    loaders: Dict[str, Tuple[str, Callable[[], Any]]],
+    load_times: Dict[str, float],
+    max_workers: int = 4,
+) -> Dict[str, Any]:
+    # runs every {name: (path, loader)} on a thread pool and fills load_times with the ms each one took.
+    # the first failure is raised right away, loaders that have not started yet are cancelled
+    def timed(name, loader):
+        start = time.perf_counter()
+        result = loader()
+        load_times[name] = (time.perf_counter() - start) * 1000
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='model-load')
+    try:
+        futures = {name: executor.submit(timed, name, loader) for name, (_, loader) in loaders.items()}
+        wait(futures.values(), return_when=FIRST_EXCEPTION)
+        for name, future in futures.items():
+            if future.done() and future.exception() is not None:
+                for other in futures.values():
+                    other.cancel()
+                raise ModelLoadError('cannot load the {} model from {}: {}'.format(
+                    name, loaders[name][0], future.exception())) from future.exception()
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        # a loader that is already running can not be interrupted, it is left to finish on its own
+        executor.shutdown(wait=False)
 
 def image_style_transfer_dualstylegan(
     frame: np.ndarray,
     style_id: int = 299,
     device: str = 'cuda',
     padding: List[int] = [120, 120, 120, 120],
-    faceDetector: Optional[FaceDetection] = None,
-    models: Optional[Tuple[VToonify, BiSeNet, GradualStyleEncoder, torch.Tensor]] = None,
+    faceDetector: Optional['FaceDetection'] = None,
+    models: Optional[Tuple[VToonify, BiSeNet, GradualStyleEncoder, StyleRegistry]] = None,
+    style_degree: float = 0.5,
 ) -> Optional[np.ndarray]:
     if models is None:
-        vtoonify, parsingpredictor, pspencoder, exstyle = create_image_style_transfer_dualstylegan_models(style_id, device)
-    else:
-        vtoonify, parsingpredictor, pspencoder, exstyle = models
+        models = create_image_style_transfer_dualstylegan_models(style_id, device)
 
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.5, 0.5, 0.5],std=[0.5,0.5,0.5]),
-        ])
+    prepared = preprocess_frame(frame, padding, faceDetector)
+    if prepared is None:
+        return None
+    origin, crop, (top, bottom, left, right) = prepared
+    output = stylize_crops([crop], device, models, style_degree, [style_id])[0]
+    return blending(origin, output, top, bottom, left, right)
 
+def preprocess_frame(
+    frame: np.ndarray,
+    padding: List[int] = [120, 120, 120, 120],
+    faceDetector: Optional['FaceDetection'] = None,
+) -> Optional[Tuple[np.ndarray, np.ndarray, Tuple[int, int, int, int]]]:
     # resize, longest edge of frame is not greater than 1k
-    H, W = frame.shape[:2]
-    if max(H, W) > 1024:
-        ratio = 1024 / max(H, W)
-        frame = cv2.resize(frame, (round(W * ratio), round(H * ratio)))
-    origin = frame.copy()
+    with stage_timer('resize'):
+        H, W = frame.shape[:2]
+        if max(H, W) > 1024:
+            ratio = 1024 / max(H, W)
+            frame = cv2.resize(frame, (round(W * ratio), round(H * ratio)))
+        origin = frame.copy()
 
     # We detect the face in the image, and resize the image so that the eye distance is 64 pixels.
     if faceDetector is None:
-        faceDetector = FaceDetection(min_detection_confidence=0.5)
-    crop_paras = get_crop_parameter_by_mediapipe(frame, faceDetector, padding)
-
+        faceDetector = new_face_detector(min_detection_confidence=0.5)
+    with stage_timer('detect'):
+        crop_paras = get_crop_parameter_by_mediapipe(frame, faceDetector, padding)
     if crop_paras is None:
         return None
-    else:
+
+    with stage_timer('crop'):
         h,w,top,bottom,left,right = crop_paras
         frame = cv2.resize(frame[top:bottom, left:right], (w, h))
 
         # we apply gaussian blur to it to avoid over-sharp stylization results
         frame = cv2.GaussianBlur(frame, (3, 3), 0)
+    return origin, frame, (top, bottom, left, right)
+
+def stylize_crops(
+    crops: List[np.ndarray],
+    device: str,
+    models: Tuple[VToonify, BiSeNet, GradualStyleEncoder, StyleRegistry],
+    style_degree: float = 0.5,
+    style_ids: Optional[List[int]] = None,
+) -> List[np.ndarray]:
+    # all crops must share the same shape, they are stacked into one batch
+    # style_ids picks one extrinsic style per crop, by default the one the models were created with
+    vtoonify, parsingpredictor, pspencoder, exstyles = models
+    if style_ids is None:
+        style_ids = [exstyles.default] * len(crops)
+    exstyle = exstyles.codes[[exstyles.lookup(i) for i in style_ids]]
+
+    from torchvision import transforms
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5],std=[0.5,0.5,0.5]),
+        ])
 
-        with torch.no_grad():
-            I = transform(frame).unsqueeze(dim=0).to(device)
-            s_w = pspencoder(I)
+    with torch.no_grad():
+        x = torch.stack([transform(crop) for crop in crops], dim=0).to(device)
+        with stage_timer('psp'):
+            s_w = pspencoder(x)
+            # pSp flattens its non-256 feature maps into several codes per image,
+            # only the first code of each image was ever used for the output
+            s_w = s_w[::s_w.size(0) // x.size(0)]
             s_w = vtoonify.zplus2wplus(s_w)
             if vtoonify.backbone == 'dualstylegan':
                 s_w[:,:7] = exstyle[:,:7]
 
-            x = transform(frame).unsqueeze(dim=0).to(device)
-            # parsing network works best on 512x512 images, so we predict parsing maps on upsmapled frames
-            # followed by downsampling the parsing maps
+        # parsing network works best on 512x512 images, so we predict parsing maps on upsmapled frames
+        # followed by downsampling the parsing maps
+        with stage_timer('parsing'):
             x_p = F.interpolate(parsingpredictor(2*(F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)))[0],
                                 scale_factor=0.5, recompute_scale_factor=False).detach()
-            torch.cuda.empty_cache()
+        torch.cuda.empty_cache()
+        with stage_timer('vtoonify'):
             # we give parsing maps lower weight (1/16)
             inputs = torch.cat((x, x_p/16.), dim=1)
             # d_s has no effect when backbone is toonify
-            y_tilde = vtoonify(inputs, s_w.repeat(inputs.size(0), 1, 1), d_s = 0.5)
+            y_tilde = vtoonify(inputs, s_w, d_s = style_degree)
             y_tilde = torch.clamp(y_tilde, -1, 1)
+            # the next batch may have another size or run on another thread, the buffers would only sit idle
+            if isinstance(vtoonify, VToonify):
+                vtoonify.release_buffers()
+            outputs = (y_tilde.detach().cpu().numpy().transpose(0, 2, 3, 1) + 1) * 0.5
 
-        output = (y_tilde[0].detach().cpu().numpy().transpose(1, 2, 0) + 1) * 0.5
-        blend = blending(origin, output, top, bottom, left, right)
-        return blend
+    return list(outputs)
 
 def blending(origin: np.ndarray, output: np.ndarray, top: int, bottom: int, left: int, right: int):
+    from matting.rembg_simplify import remove
     output = cv2.resize(output, (right - left, bottom - top))
     if origin.max() <= 1:
         origin = (origin * 255).astype(np.uint8)
@@ -146,8 +270,10 @@ def blending(origin: np.ndarray, output: np.ndarray, top: int, bottom: int, left
         output = (output * 255).astype(np.uint8)
 
     # matte the human part and do blending
-    mask_output = remove(output, only_mask=True)
-    mask_origin = remove(origin, only_mask=True)
+    with stage_timer('matting_output'):
+        mask_output = remove(output, only_mask=True)
+    with stage_timer('matting_origin'):
+        mask_origin = remove(origin, only_mask=True)
     mask = np.where((mask_output + mask_origin[top:bottom, left:right]) > 10, 255 * np.ones_like(mask_output), np.zeros_like(mask_output))
 
     # the hair part changes a lot and face part may shrink, so I dilate the mask
@@ -170,19 +296,51 @@ def blending(origin: np.ndarray, output: np.ndarray, top: int, bottom: int, left
     else:
         origin_blur = origin.copy()
 
-    blend = cv2.seamlessClone(output, origin_blur, mask, center, cv2.NORMAL_CLONE)
+    with stage_timer('seamless_clone'):
+        blend = cv2.seamlessClone(output, origin_blur, mask, center, cv2.NORMAL_CLONE)
 
     # smooth the edge region of mask
     weight = np.zeros_like(blend)[..., 0]
     weight[top:bottom, left:right] = mask
-    weight_field = create_weight_field(weight, kernel_size=(5, 5), iterations=30, a=1.1)
+    with stage_timer('weight_field'):
+        weight_field = create_weight_field(weight, kernel_size=(5, 5), iterations=30, a=1.1)
     if len(weight_field.shape) == 2:
         weight_field = weight_field[..., np.newaxis]
     blend = (blend / 255.) * weight_field + (origin_blur / 255.) * (1 - weight_field)
     return (blend * 255).astype(np.uint8)
 
+def warmup_image_style_transfer_dualstylegan(
+    device: str,
+    models: Tuple[VToonify, BiSeNet, GradualStyleEncoder, StyleRegistry],
+    crop_sizes: List[Tuple[int, int]] = [(288, 288)],
+    faceDetector: Optional['FaceDetection'] = None,
+    passes: int = 2,
+) -> Dict[str, float]:
+    # push synthetic frames through detection, the models and blending, so that allocator growth,
+    # oneDNN primitives and the onnxruntime session are set up before real traffic arrives.
+    # returns the latency (ms) of the last pass for every crop size
+    if faceDetector is None:
+        faceDetector = new_face_detector(min_detection_confidence=0.5)
+    latency = {}
+    for h, w in crop_sizes:
+        origin = np.random.randint(0, 256, (h, w, 3), dtype=np.uint8)
+        for _ in range(passes):
+            start = time.time()
+            get_crop_parameter_by_mediapipe(origin, faceDetector)
+            output = stylize_crops([origin], device, models)[0]
+            try:
+                blending(origin, output, 0, h, 0, w)
+            except cv2.error:
+                # the matting mask of noise may be empty, seamlessClone rejects that
+                pass
+            latency['{}x{}'.format(h, w)] = (time.time() - start) * 1000
+    return latency
+
     
 if __name__ == "__main__":
+    from torchvision import transforms
+    from model.encoder.align_all_parallel import align_face
+    import matplotlib.pyplot as plt
 
     parser = TestOptions()
     args = parser.parse()
@@ -197,7 +355,7 @@ if __name__ == "__main__":
         ])
     
     vtoonify = VToonify(backbone = args.backbone)
-    vtoonify.load_state_dict(torch.load(args.ckpt, map_location=lambda storage, loc: storage)['g_ema'])
+    load_vtoonify(vtoonify, args.ckpt)
     vtoonify.to(device)
 
     parsingpredictor = BiSeNet(n_classes=19)
@@ -216,9 +374,7 @@ if __name__ == "__main__":
     pspencoder = load_psp_standalone(args.style_encoder_path, device)    
 
     if args.backbone == 'dualstylegan':
-        exstyles = np.load(args.exstyle_path, allow_pickle='TRUE').item()
-        stylename = list(exstyles.keys())[args.style_id]
-        exstyle = torch.tensor(exstyles[stylename]).to(device)
+        exstyle = torch.tensor(ExstyleStore.open(args.exstyle_path).zplus(args.style_id)).to(device)
         with torch.no_grad():  
             exstyle = vtoonify.zplus2wplus(exstyle)
 
@@ -284,6 +440,8 @@ if __name__ == "__main__":
                             s_w = exstyle
                         else:
                             s_w[:,:7] = exstyle[:,:7]
+                    # every frame has the same style, its kernels are computed once for the whole video
+                    vtoonify_baked = vtoonify.compile_for_style(s_w, args.style_degree)
                 first_valid_frame = False
             elif args.scale_image:
                 if scale <= 0.75:
@@ -310,7 +468,7 @@ if __name__ == "__main__":
                     # we give parsing maps lower weight (1/16)
                     inputs = torch.cat((x, x_p/16.), dim=1)
                     # d_s has no effect when backbone is toonify
-                    y_tilde = vtoonify(inputs, s_w.repeat(inputs.size(0), 1, 1), d_s = args.style_degree)       
+                    y_tilde = vtoonify_baked(inputs)
                     y_tilde = torch.clamp(y_tilde, -1, 1)
                 for k in range(y_tilde.size(0)):
                     videoWriter2.write(tensor2cv2(y_tilde[k].cpu()))
@@ -14,6 +14,7 @@ from torchvision import transforms, utils
 from tqdm import tqdm
 from PIL import Image
 from util import *
+from delta_checkpoint import split_state_dict, backbone_fingerprint, backbone_filename, save_backbone, save_delta
 from model.stylegan import lpips
 from model.stylegan.model import Generator, Downsample
 from model.vtoonify import VToonify, ConditionalDiscriminator
@@ -62,6 +63,7 @@ class TrainOptions():
         
         self.parser.add_argument("--name", type=str, default='vtoonify_t_cartoon', help="saved model name")
         self.parser.add_argument("--pretrain", action="store_true", help="if true, only pretrain the encoder")
+        self.parser.add_argument("--full_checkpoint", action="store_true", help="save the whole g_ema instead of the trained modules on a shared backbone file")
 
     def parse(self):
         self.opt = self.parser.parse_args()
@@ -309,14 +311,17 @@ def train(args, generator, discriminator, g_optim, d_optim, g_ema, percept, pars
                     savename = f"checkpoint/%s/vtoonify.pt"%(args.name)
                 else:
                     savename = f"checkpoint/%s/vtoonify_%05d.pt"%(args.name, i+1)                
-                torch.save(
-                    {
-                        #"g": g_module.state_dict(),
-                        #"d": d_module.state_dict(),
-                        "g_ema": g_ema.state_dict(),
-                    },
-                    savename,
-                )
+                if args.full_checkpoint:
+                    torch.save(
+                        {
+                            #"g": g_module.state_dict(),
+                            #"d": d_module.state_dict(),
+                            "g_ema": g_ema.state_dict(),
+                        },
+                        savename,
+                    )
+                else:
+                    save_delta(savename, g_ema.state_dict(), args.backbone_fingerprint, g_ema.backbone, args.backbone_path)
                 
                 
 
@@ -370,6 +375,15 @@ if __name__ == "__main__":
     accumulate(g_ema.fusion_out, generator.fusion_out, 0)
     accumulate(g_ema.fusion_skip, generator.fusion_skip, 0) 
 
+    # the backbone stays frozen, it is saved once and the checkpoints only keep the trained modules
+    args.backbone_fingerprint, args.backbone_path = None, None
+    if not args.pretrain and not args.full_checkpoint:
+        _, backbone = split_state_dict(g_ema.state_dict())
+        args.backbone_fingerprint = backbone_fingerprint(backbone)
+        args.backbone_path = os.path.join('checkpoint', args.name, backbone_filename(args.backbone_fingerprint))
+        if args.local_rank == 0:
+            save_backbone(os.path.join('checkpoint', args.name), backbone, args.backbone_fingerprint, g_ema.backbone)
+
     g_parameters = list(generator.encoder.parameters()) 
     if not args.pretrain:
         g_parameters = g_parameters + list(generator.fusion_out.parameters()) + list(generator.fusion_skip.parameters())
@@ -1,5 +1,5 @@
+import io
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
 import cv2
 import random
@@ -10,13 +10,16 @@ from torch.utils import data
 from torch.nn import functional as F
 from torch import autograd
 from torch.nn import init
-import torchvision.transforms as transforms
+from typing import TYPE_CHECKING
 from model.stylegan.op_cpu import conv2d_gradfix
 from model.encoder.encoders.psp_encoders import GradualStyleEncoder
-from model.encoder.align_all_parallel import get_landmark
-from mediapipe.python.solutions.face_detection import FaceDetection
+# matplotlib, torchvision, dlib and mediapipe are imported where they are used,
+# importing them here costs every process seconds of start-up
+if TYPE_CHECKING:
+    from mediapipe.python.solutions.face_detection import FaceDetection
     
 def visualize(img_arr, dpi):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(10,10),dpi=dpi)
     plt.imshow(((img_arr.detach().cpu().numpy().transpose(1, 2, 0) + 1.0) * 127.5).astype(np.uint8))
     plt.axis('off')
@@ -27,6 +30,7 @@ def save_image(img, filename):
     cv2.imwrite(filename, cv2.cvtColor(tmp, cv2.COLOR_RGB2BGR))
     
 def load_image(filename):
+    import torchvision.transforms as transforms
     transform = transforms.Compose([
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.5, 0.5, 0.5],std=[0.5,0.5,0.5]),
@@ -141,6 +145,15 @@ def weights_init(m):
             init.constant_(m.bias.data, 0.0) 
             
             
+def add_latent_avg_hook(psp, latent_avg):
+    # pSp predicts the offset of every code from the average latent
+    def add_latent_avg(model, inputs, outputs):
+        return outputs + latent_avg.repeat(outputs.shape[0], 1, 1)
+
+    psp.latent_avg = latent_avg
+    psp.register_forward_hook(add_latent_avg)
+    return psp
+
 def load_psp_standalone(checkpoint_path, device='cuda'):
     ckpt = torch.load(checkpoint_path, map_location='cpu')
     opts = ckpt['opts']
@@ -153,15 +166,14 @@ def load_psp_standalone(checkpoint_path, device='cuda'):
     psp.load_state_dict(psp_dict)
     psp.eval()
     psp = psp.to(device)
+    psp.opts = opts
     latent_avg = ckpt['latent_avg'].to(device)
-
-    def add_latent_avg(model, inputs, outputs):
-        return outputs + latent_avg.repeat(outputs.shape[0], 1, 1)
-
-    psp.register_forward_hook(add_latent_avg)
+    add_latent_avg_hook(psp, latent_avg)
     return psp
 
 def get_video_crop_parameter(filepath, predictor, padding=[200,200,200,200]):
+    import dlib
+    from model.encoder.align_all_parallel import get_landmark
     if type(filepath) == str:
         img = dlib.load_rgb_image(filepath)
     else:
@@ -188,7 +200,11 @@ def get_video_crop_parameter(filepath, predictor, padding=[200,200,200,200]):
     bottom = min(round(center[1] + padding[3]), h) // 8 * 8
     return h,w,top,bottom,left,right,scale
 
-def get_crop_parameter_by_mediapipe(img: np.ndarray, faceDetection: FaceDetection, padding=[200, 200, 200, 200]):
+def new_face_detector(min_detection_confidence=0.5) -> 'FaceDetection':
+    from mediapipe.python.solutions.face_detection import FaceDetection
+    return FaceDetection(min_detection_confidence=min_detection_confidence)
+
+def get_crop_parameter_by_mediapipe(img: np.ndarray, faceDetection: 'FaceDetection', padding=[200, 200, 200, 200]):
     results = faceDetection.process(img)
     if results.detections:
         keypoints = results.detections[0].location_data.relative_keypoints
@@ -279,11 +295,30 @@ def blend_models(G_low, G_high, weight=[1]*7+[0]*11):
     return state_dict
 
 # for flask server
-def decode_received_image_data(img_data):
+REDUCED_DECODE_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def get_decode_flag(img_data, max_size=None):
+  # read only the header, and let libjpeg scale the DCT by 1/2, 1/4 or 1/8 while decoding,
+  # as long as the longest edge stays >= max_size, so the full-resolution bitmap is never built
+  if max_size is None:
+    return cv2.IMREAD_COLOR
+  try:
+    with Image.open(io.BytesIO(img_data)) as header:
+      if header.format != 'JPEG':
+        return cv2.IMREAD_COLOR
+      longest_edge = max(header.size)
+  except (OSError, Image.DecompressionBombError):
+    return cv2.IMREAD_COLOR
+  for factor, flag in REDUCED_DECODE_FLAGS:
+    if longest_edge // factor >= max_size:
+      return flag
+  return cv2.IMREAD_COLOR
+
+def decode_received_image_data(img_data, max_size=None):
   data = np.frombuffer(img_data, np.uint8)
-  img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+  img = cv2.imdecode(data, get_decode_flag(img_data, max_size))
   return img
 
-def encode_image_to_bytes(fmt, image):
-  _, encoded_image = cv2.imencode(fmt, np.asarray(image))
+def encode_image_to_bytes(fmt, image, params=None):
+  _, encoded_image = cv2.imencode(fmt, np.asarray(image), params or [])
   return encoded_image.tobytes()
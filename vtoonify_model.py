@@ -5,25 +5,30 @@ import gradio as gr
 import pathlib
 import sys
 
+from resource_pool import ResourcePool
+from style_cache import StyleCache
+from model_store import ModelStore
+from exstyle_store import ExstyleStore
 from util import load_psp_standalone, get_video_crop_parameter, tensor2cv2
 import torch
 import torch.nn as nn
 import numpy as np
 import dlib
 import cv2
-from model.vtoonify import VToonify
 from model.bisenet.model import BiSeNet
 import torch.nn.functional as F
 from torchvision import transforms
 from model.encoder.align_all_parallel import align_face
 import gc
+from typing import Optional
 import huggingface_hub
 import os
 
 MODEL_REPO = 'PKUWilliamYang/VToonify'
 
 class Model():
-    def __init__(self, device):
+    def __init__(self, device, num_predictors: int = 2, max_style_bytes: int = 3 << 30, prefetch_styles: int = 1,
+                 model_dir: Optional[str] = None, offline: bool = False):
         super().__init__()
         
         self.device = device
@@ -52,7 +57,14 @@ class Model():
             'illustration5-d': ['vtoonify_d_illustration/vtoonify_s086_d_c.pt', 86],
         }
         
-        self.landmarkpredictor = self._create_dlib_landmark_model()
+        # model_dir is a local copy of the hub repo (with a manifest.json, see model_store.py). with it,
+        # every file is resolved and checked once here, offline nothing is downloaded at all
+        self.models = ModelStore(model_dir, offline, fetch=lambda name: huggingface_hub.hf_hub_download(MODEL_REPO, name))
+        if model_dir is not None:
+            self.models.resolve_all(self._model_names())
+
+        # gradio calls in from several threads, each detection checks out its own predictor
+        self.landmarkpredictors = ResourcePool(self._create_dlib_landmark_model, num_predictors, 'dlib predictor')
         self.parsingpredictor = self._create_parsing_model()
         self.pspencoder = self._load_encoder()    
         self.transform = transforms.Compose([
@@ -60,36 +72,46 @@ class Model():
             transforms.Normalize(mean=[0.5, 0.5, 0.5],std=[0.5,0.5,0.5]),
             ])
         
+        self.exstyle_stores = {}
+        # styles stay on the device, the ones sharing a DualStyleGAN backbone share one copy of it
+        self.styles = StyleCache(self.device, max_style_bytes, 'dualstylegan', prefetch_workers=1 if prefetch_styles > 0 else 0,
+                                 resolve=self.models.resolve)
+        self.prefetch_styles = prefetch_styles
         self.vtoonify, self.exstyle = self._load_default_model()
         self.color_transfer = False
         self.style_name = 'cartoon1'
         self.video_limit_cpu = 100
         self.video_limit_gpu = 300
         
-    @staticmethod
-    def _create_dlib_landmark_model():
-        return dlib.shape_predictor(huggingface_hub.hf_hub_download(MODEL_REPO,
-                                                    'models/shape_predictor_68_face_landmarks.dat'))
+    def _model_names(self) -> list[str]:
+        names = ['models/shape_predictor_68_face_landmarks.dat', 'models/faceparsing.pth', 'models/encoder.pt']
+        for model_path, _ in self.style_types.values():
+            names += ['models/'+model_path, os.path.join('models', os.path.dirname(model_path), 'exstyle_code.npy')]
+        return list(dict.fromkeys(names))
+
+    def _create_dlib_landmark_model(self):
+        return dlib.shape_predictor(self.models.resolve('models/shape_predictor_68_face_landmarks.dat'))
     
     def _create_parsing_model(self):
         parsingpredictor = BiSeNet(n_classes=19)
-        parsingpredictor.load_state_dict(torch.load(huggingface_hub.hf_hub_download(MODEL_REPO, 'models/faceparsing.pth'),
+        parsingpredictor.load_state_dict(torch.load(self.models.resolve('models/faceparsing.pth'),
                                                     map_location=lambda storage, loc: storage))
         parsingpredictor.to(self.device).eval()
         return parsingpredictor
     
     def _load_encoder(self) -> nn.Module:
-        style_encoder_path = huggingface_hub.hf_hub_download(MODEL_REPO,'models/encoder.pt')
+        style_encoder_path = self.models.resolve('models/encoder.pt')
         return load_psp_standalone(style_encoder_path, self.device)
     
+    def _exstyle_store(self, style_path: str) -> ExstyleStore:
+        # every style of a checkpoint dir shares one exstyle_code.npy, it is read once
+        if style_path not in self.exstyle_stores:
+            self.exstyle_stores[style_path] = ExstyleStore.open(self.models.resolve(style_path))
+        return self.exstyle_stores[style_path]
+
     def _load_default_model(self) -> tuple[torch.Tensor, str]:
-        vtoonify = VToonify(backbone = 'dualstylegan')
-        vtoonify.load_state_dict(torch.load(huggingface_hub.hf_hub_download(MODEL_REPO,
-                                            'models/vtoonify_d_cartoon/vtoonify_s026_d0.5.pt'), 
-                                            map_location=lambda storage, loc: storage)['g_ema'])
-        vtoonify.to(self.device)
-        tmp = np.load(huggingface_hub.hf_hub_download(MODEL_REPO,'models/vtoonify_d_cartoon/exstyle_code.npy'), allow_pickle=True).item()
-        exstyle = torch.tensor(tmp[list(tmp.keys())[26]]).to(self.device)
+        vtoonify = self.styles.get('models/vtoonify_d_cartoon/vtoonify_s026_d0.5.pt').lean_inference()
+        exstyle = torch.tensor(self._exstyle_store('models/vtoonify_d_cartoon/exstyle_code.npy').zplus(26)).to(self.device)
         with torch.no_grad():  
             exstyle = vtoonify.zplus2wplus(exstyle)
         return vtoonify, exstyle
@@ -104,17 +126,37 @@ class Model():
         self.style_name = style_type
         model_path, ind = self.style_types[style_type]
         style_path = os.path.join('models',os.path.dirname(model_path),'exstyle_code.npy')
-        self.vtoonify.load_state_dict(torch.load(huggingface_hub.hf_hub_download(MODEL_REPO,'models/'+model_path), 
-                                            map_location=lambda storage, loc: storage)['g_ema'])
-        tmp = np.load(huggingface_hub.hf_hub_download(MODEL_REPO, style_path), allow_pickle=True).item()
-        exstyle = torch.tensor(tmp[list(tmp.keys())[ind]]).to(self.device)
+        # a resident style is only a pointer swap
+        self.vtoonify = self.styles.get('models/'+model_path).lean_inference()
+        self._prefetch_after(style_type)
+        exstyle = torch.tensor(self._exstyle_store(style_path).zplus(ind)).to(self.device)
         with torch.no_grad():  
             exstyle = self.vtoonify.zplus2wplus(exstyle)
         return exstyle, 'Model of %s loaded.'%(style_type)
     
+    def _prefetch_after(self, style_type: str):
+        # users tend to step through the style list in order, the next checkpoints are loaded ahead
+        if self.prefetch_styles <= 0:
+            return
+        names = list(self.style_types.keys())
+        start = names.index(style_type)
+        current = self.style_types[style_type][0]
+        upcoming = []
+        for name in names[start+1:] + names[:start]:
+            model_path = self.style_types[name][0]
+            if model_path != current and model_path not in upcoming:
+                upcoming.append(model_path)
+            if len(upcoming) == self.prefetch_styles:
+                break
+        self.styles.prefetch('models/'+model_path for model_path in upcoming)
+
     def detect_and_align(self, frame, top, bottom, left, right, return_para=False):
+        with self.landmarkpredictors.checkout() as landmarkpredictor:
+            return self._detect_and_align(frame, top, bottom, left, right, return_para, landmarkpredictor)
+
+    def _detect_and_align(self, frame, top, bottom, left, right, return_para, landmarkpredictor):
         message = 'Error: no face detected! Please retry or change the photo.'
-        paras = get_video_crop_parameter(frame, self.landmarkpredictor, [left, right, top, bottom])
+        paras = get_video_crop_parameter(frame, landmarkpredictor, [left, right, top, bottom])
         instyle = None
         h, w, scale = 0, 0, 0
         if paras is not None:
@@ -128,7 +170,7 @@ class Model():
                 frame = cv2.sepFilter2D(frame, -1, kernel_1d, kernel_1d)
             frame = cv2.resize(frame, (w, h))[top:bottom, left:right]
             with torch.no_grad():
-                I = align_face(frame, self.landmarkpredictor)
+                I = align_face(frame, landmarkpredictor)
                 if I is not None:
                     I = self.transform(I).unsqueeze(dim=0).to(self.device)
                     instyle = self.pspencoder(I)
@@ -257,6 +299,7 @@ class Model():
             else:
                 s_w = instyle.clone()
                 s_w[:,:7] = exstyle[:,:7]
+            vtoonify_baked = self.vtoonify.compile_for_style(s_w, style_degree)
             for i in range(num):
                 success, frame = video_cap.read()
                 frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
@@ -268,7 +311,7 @@ class Model():
                         x_p = F.interpolate(self.parsingpredictor(2*(F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)))[0], 
                                             scale_factor=0.5, recompute_scale_factor=False).detach()
                         inputs = torch.cat((x, x_p/16.), dim=1)
-                        y_tilde = self.vtoonify(inputs, s_w.repeat(inputs.size(0), 1, 1), style_degree)       
+                        y_tilde = vtoonify_baked(inputs)
                         y_tilde = torch.clamp(y_tilde, -1, 1)
                     for k in range(y_tilde.size(0)):
                         videoWriter.write(tensor2cv2(y_tilde[k].cpu()))
@@ -0,0 +1,207 @@
+import queue
+import pickle
+import threading
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+import metrics
+from batching import wait_result
+from style_registry import StyleRegistry
+
+
+class WorkerPool():
+    '''
+    Runs the stylization pipeline in forked worker processes.
+
+    The models are loaded once in the parent and moved to shared memory before forking, so all
+    workers map the same VToonify/BiSeNet/pSp weights. Tasks wait in one queue in the parent, a
+    thread per worker hands the next one to its worker over that worker's own pipe as soon as it
+    is idle. Only usable on cpu, since CUDA does not survive a fork. Every worker warms up on
+    `warmup_sizes` before taking tasks.
+
+    A worker that dies (oom kill, a crash in native code) only takes its own pipe down: its task
+    fails and a new fork replaces it. Exceptions raised in a worker keep their type.
+    '''
+    def __init__(self,
+                 models: Tuple[torch.nn.Module, torch.nn.Module, torch.nn.Module, StyleRegistry],
+                 device: str = 'cpu',
+                 num_workers: int = 2,
+                 num_threads: int = 1,
+                 warmup_sizes: List[Tuple[int, int]] = []):
+        if device != 'cpu':
+            raise ValueError('worker pool only supports cpu, got device {}'.format(device))
+
+        vtoonify, parsingpredictor, pspencoder, exstyles = models
+        if getattr(vtoonify, 'bundle_path', None) is None:
+            for module in (vtoonify, parsingpredictor, pspencoder):
+                module.share_memory()
+            exstyles.codes.share_memory_()
+        # weights mapped from an inference bundle are shared through the page cache already,
+        # share_memory would copy them into /dev/shm
+
+        self._ctx = mp.get_context('fork')
+        self._worker_args = (models, device, num_threads, warmup_sizes)
+        self.tasks = queue.Queue()
+        self.num_restarts = 0
+        self.warm_latency: List[Dict[str, float]] = []
+        self._lock = threading.Lock()
+        # no fork may happen while the child end of another worker's pipe is still open in the parent,
+        # the new worker would keep it open and the parent would never see that worker's pipe close
+        self._fork_lock = threading.Lock()
+        self.workers = [None] * num_workers
+        self._conns = [None] * num_workers
+        self._threads = [threading.Thread(target=self._serve, args=(i,), name='worker-pool-{}'.format(i), daemon=True)
+                         for i in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, image: np.ndarray, padding: List[int], style_id: int, style_degree: float,
+               deadline: Optional[float] = None) -> Future:
+        future = Future()
+        self.tasks.put((image, padding, style_id, style_degree, deadline, future))
+        return future
+
+    def __call__(self, image: np.ndarray, padding: List[int], style_id: int, style_degree: float,
+                 deadline: Optional[float] = None) -> Optional[Tuple[np.ndarray, Tuple[int, int, int, int]]]:
+        future = self.submit(image, padding, style_id, style_degree, deadline)
+        output = wait_result(future, deadline)
+        # stage timings come back from the worker process and are observed here
+        metrics.record_timings(future.timings)
+        return output
+
+    @property
+    def warmed_up(self) -> bool:
+        # a restarted worker reports its warm-up again
+        return len(self.warm_latency) >= len(self.workers)
+
+    def close(self):
+        for _ in self._threads:
+            self.tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _start_worker(self, index: int):
+        with self._fork_lock:
+            conn, child_conn = self._ctx.Pipe()
+            worker = self._ctx.Process(target=_worker_loop, args=(child_conn,) + self._worker_args,
+                                       name='vtoonify-worker-{}'.format(index), daemon=True)
+            worker.start()
+            child_conn.close()
+        self.workers[index], self._conns[index] = worker, conn
+
+    def _receive(self, index: int):
+        # the next message of the worker, or None once it is gone. a message sent just before
+        # it exited is still read
+        worker, conn = self.workers[index], self._conns[index]
+        wait([conn, worker.sentinel])
+        try:
+            if conn.poll():
+                return conn.recv()
+        except (EOFError, OSError):
+            pass
+        return None
+
+    def _restart(self, index: int):
+        self.workers[index].join()
+        self._conns[index].close()
+        with self._lock:
+            self.num_restarts += 1
+        # a worker that dies while starting up would otherwise be forked again right away
+        time.sleep(1.)
+        self._start_worker(index)
+
+    def _serve(self, index: int):
+        # one worker, through its restarts, until the pool is closed
+        self._start_worker(index)
+        task = None
+        while True:
+            latency = self._receive(index)
+            if latency is not None:
+                with self._lock:
+                    self.warm_latency.append(latency)
+                closed, task = self._feed(index, task)
+                if closed:
+                    return
+            self._restart(index)
+
+    def _feed(self, index: int, task):
+        # runs tasks on the worker until it is gone, gives (closed, the task its replacement is to run)
+        worker, conn = self.workers[index], self._conns[index]
+        while True:
+            if task is None:
+                task = self.tasks.get()
+                if task is None:
+                    try:
+                        conn.send(None)
+                    except OSError:
+                        pass
+                    worker.join()
+                    return True, None
+            if not worker.is_alive():
+                # died while idle, the task waits for the replacement
+                return False, task
+            image, padding, style_id, style_degree, deadline, future = task
+            task = None
+            if not future.set_running_or_notify_cancel():
+                continue
+            future.timings = []
+            if deadline is not None and time.monotonic() > deadline:
+                future.set_exception(TimeoutError('deadline exceeded while waiting for a worker'))
+                continue
+            try:
+                conn.send((image, padding, style_id, style_degree))
+                result = self._receive(index)
+            except OSError:
+                result = None
+            if result is None:
+                worker.join()
+                future.set_exception(RuntimeError('{} died with exit code {}'.format(worker.name, worker.exitcode)))
+                return False, None
+            output, future.timings, error = result
+            if error is None:
+                future.set_result(output)
+            else:
+                future.set_exception(error)
+
+
+def _picklable(e: Exception) -> Exception:
+    # the exception goes back to the parent as is, unless it does not pickle
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(repr(e))
+
+
+def _worker_loop(conn, models, device, num_threads, warmup_sizes):
+    # per-process state is created after the fork, neither mediapipe nor onnxruntime are fork safe
+    torch.set_num_threads(num_threads)
+    from matting import rembg_simplify
+    from util import new_face_detector
+    from style_transfer import preprocess_frame, stylize_crops, blending, warmup_image_style_transfer_dualstylegan
+    rembg_simplify.sessions.reset()
+    faceDetector = new_face_detector()
+    conn.send(warmup_image_style_transfer_dualstylegan(device, models, warmup_sizes, faceDetector))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        image, padding, style_id, style_degree = task
+        output, error = None, None
+        with metrics.collect() as timings:
+            try:
+                prepared = preprocess_frame(image, padding, faceDetector)
+                if prepared is not None:
+                    origin, crop, box = prepared
+                    stylized = stylize_crops([crop], device, models, style_degree, [style_id])[0]
+                    output = (blending(origin, stylized, *box), box)
+            except Exception as e:
+                error = _picklable(e)
+        conn.send((output, timings, error))